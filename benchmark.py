@@ -0,0 +1,197 @@
+"""Benchmarks for bikeshare.py on synthetic city data.
+
+Generates CSV files with the real bikeshare schema, times load_data, the statistics
+functions and a scripted main() session, and appends one JSON line per measurement
+(wall time, rows per second, peak traced memory) to a results file.
+
+    python benchmark.py --rows 100000 1000000 --stations 800 --output bench_results.jsonl
+"""
+import argparse
+import builtins
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import bikeshare
+
+# Peak memory is traced with tracemalloc, which slows allocation-heavy code a little;
+# --no-memory turns it off for the cleanest timings
+TRACE_MEMORY = True
+
+
+def generate_city_csv(filename, rows, stations=600, user_details=True, seed=0, chunk_rows=1000000):
+    """Writes a synthetic city CSV file with the bikeshare schema.
+
+    Args:
+        (str) filename - path of the CSV file to write
+        (int) rows - number of trips
+        (int) stations - number of distinct station names
+        (bool) user_details - include the 'Gender' and 'Birth Year' columns (washington has neither)
+        (int) seed - random seed, so runs are repeatable
+        (int) chunk_rows - rows generated and written at a time
+    """
+    rng = np.random.default_rng(seed)
+    names = np.array(['Station %d' % number for number in range(stations)], dtype=object)
+    # A few busy stations and a long tail, like the real files
+    weights = 1.0 / np.arange(1, stations + 1)
+    weights /= weights.sum()
+    first_second = np.datetime64('2017-01-01T00:00:00')
+    half_year = 181 * 86400
+
+    with open(filename, 'w', newline='') as city_file:
+        for first_row in range(0, rows, chunk_rows):
+            count = min(chunk_rows, rows - first_row)
+            start = first_second + rng.integers(0, half_year, count).astype('timedelta64[s]')
+            duration = rng.gamma(2.0, 500.0, count).round() + 60
+            chunk = {'Unnamed: 0': np.arange(first_row, first_row + count),
+                     'Start Time': start,
+                     'End Time': start + duration.astype('timedelta64[s]'),
+                     'Trip Duration': duration,
+                     'Start Station': names[rng.choice(stations, count, p=weights)],
+                     'End Station': names[rng.choice(stations, count, p=weights)],
+                     'User Type': rng.choice(np.array(['Subscriber', 'Customer', 'Dependent'], dtype=object),
+                                             count, p=[0.8, 0.199, 0.001])}
+            if user_details:
+                gender = rng.choice(np.array(['Male', 'Female', None], dtype=object), count, p=[0.6, 0.25, 0.15])
+                birth_year = rng.normal(1981, 11, count).round().clip(1900, 2002)
+                birth_year[gender == None] = np.nan  # noqa: E711 - elementwise comparison
+                chunk['Gender'] = gender
+                chunk['Birth Year'] = birth_year
+            pd.DataFrame(chunk).to_csv(city_file, index=False, header=first_row == 0,
+                                       date_format='%Y-%m-%d %H:%M:%S')
+
+
+def measure(name, rows, function, *args):
+    """Runs function(*args) once with its output hidden and returns a result record."""
+    if TRACE_MEMORY:
+        tracemalloc.start()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        function(*args)
+    elapsed = time.perf_counter() - start
+    peak = None
+    if TRACE_MEMORY:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {'benchmark': name, 'rows': rows, 'seconds': elapsed,
+            'rows_per_second': rows / elapsed if elapsed else None, 'peak_bytes': peak}
+
+
+def measure_command(name, rows, args, repeat=3):
+    """Runs bikeshare.py as a new process with args and returns a record of its best wall time.
+
+    This includes interpreter start-up and imports, which is what a scripted invocation pays.
+    """
+    command = [sys.executable, os.path.abspath(bikeshare.__file__)] + args
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL, check=True)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return {'benchmark': name, 'rows': rows, 'seconds': best, 'rows_per_second': None, 'peak_bytes': None}
+
+
+def scripted_main(city, month, day):
+    """Runs one main() session with the answers to its prompts given in advance."""
+    answers = iter([city, month, day, 'no', 'no'])
+    real_input = builtins.input
+    builtins.input = lambda prompt='': next(answers)
+    try:
+        bikeshare.main()
+    finally:
+        builtins.input = real_input
+
+
+def run_benchmarks(rows, stations, month, day, workdir):
+    """Generates one full-schema and one washington-style city and times every stage on both.
+
+    Returns:
+        (list) result records, each also tagged with the city and generator settings
+    """
+    os.chdir(workdir)
+    bikeshare.CACHE_DIR = os.path.join(workdir, 'cache')
+    bikeshare.PARTITION_DIR = os.path.join(workdir, 'partitions')
+    bikeshare.CITY_DATA = {'chicago': 'chicago.csv', 'washington': 'washington.csv'}
+
+    results = []
+    for city, user_details in [('chicago', True), ('washington', False)]:
+        bikeshare.frame_cache.clear()
+        bikeshare.cube_cache.clear()
+        start = time.perf_counter()
+        generate_city_csv(bikeshare.CITY_DATA[city], rows, stations, user_details)
+        print('Generated %s (%d rows) in %.1f seconds.' % (city, rows, time.perf_counter() - start))
+
+        city_results = [measure('load_data (csv)', rows, bikeshare.load_data, city, month, day)]
+        bikeshare.frame_cache.clear()
+        city_results.append(measure('load_data (disk cache)', rows, bikeshare.load_data, city, month, day))
+        city_results.append(measure('load_data (memory)', rows, bikeshare.load_data, city, month, day))
+
+        df = bikeshare.load_data(city, month, day)
+        city_results.append(measure('compute_stats', len(df), bikeshare.compute_stats, df, city))
+        city_results.append(measure('time_stats', len(df), bikeshare.time_stats, df))
+        city_results.append(measure('station_stats', len(df), bikeshare.station_stats, df))
+        city_results.append(measure('trip_duration_stats', len(df), bikeshare.trip_duration_stats, df))
+        city_results.append(measure('user_stats', len(df), bikeshare.user_stats, df, city))
+        city_results.append(measure('duration_analytics', len(df), bikeshare.duration_analytics, df))
+        city_results.append(measure('main (warm)', rows, scripted_main, city, month, day))
+        bikeshare.frame_cache.clear()
+        city_results.append(measure('main (disk cache)', rows, scripted_main, city, month, day))
+
+        # Whole-process timings of the command line, start-up and imports included
+        query = ['--city', city, '--month', month, '--day', day]
+        city_results.append(measure_command('cli --list-cities', 0, ['--list-cities']))
+        city_results.append(measure_command('cli text', rows, query))
+        city_results.append(measure_command('cli json (answered)', rows, query + ['--format', 'json']))
+
+        for result in city_results:
+            result.update({'city': city, 'stations': stations, 'month': month, 'day': day})
+            print('%-24s %-10s %8.3f s  %12.0f rows/s  %8.1f MB peak' % (
+                result['benchmark'], city, result['seconds'], result['rows_per_second'] or 0,
+                (result['peak_bytes'] or 0) / 1e6))
+        results.extend(city_results)
+    return results
+
+
+def main():
+    """Parses the command line and runs the benchmarks for every requested size."""
+    parser = argparse.ArgumentParser(description='Benchmark bikeshare.py on synthetic city data.')
+    parser.add_argument('--rows', type=int, nargs='+', default=[100000],
+                        help='city sizes to benchmark, e.g. 100000 1000000 50000000')
+    parser.add_argument('--stations', type=int, default=600, help='number of distinct stations')
+    parser.add_argument('--month', default='all')
+    parser.add_argument('--day', default='all')
+    parser.add_argument('--output', default='bench_results.jsonl', help='JSON lines file the results are appended to')
+    parser.add_argument('--no-memory', action='store_true', help='do not trace peak memory')
+    options = parser.parse_args()
+    global TRACE_MEMORY
+    TRACE_MEMORY = not options.no_memory
+    output = os.path.abspath(options.output)
+
+    run_info = {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+                'pandas': pd.__version__, 'numpy': np.__version__, 'machine': platform.machine()}
+    for rows in options.rows:
+        with tempfile.TemporaryDirectory(prefix='bikeshare-bench-') as workdir:
+            previous_dir = os.getcwd()
+            try:
+                results = run_benchmarks(rows, options.stations, options.month, options.day, workdir)
+            finally:
+                os.chdir(previous_dir)
+        with open(output, 'a') as results_file:
+            for result in results:
+                results_file.write(json.dumps(dict(run_info, **result)) + '\n')
+    print('Results appended to', output)
+
+
+if __name__ == '__main__':
+    main()
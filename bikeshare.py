@@ -1,580 +1,2561 @@
+import argparse
+import atexit
+import contextlib
+import csv
+import importlib
+import io
+import json
+import os
+import pickle
+import re
+import sys
+import threading
 import time
-import pandas as pd
+import tracemalloc
+from collections import OrderedDict
+from urllib.parse import parse_qs, urlsplit
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: the column store is then written without a cross-process lock
+    fcntl = None
+
+
+class LazyModule:
+    """Stands in for a module that is only imported when one of its attributes is first used.
+
+    numpy, pandas, asyncio and concurrent.futures are most of the start-up time, and commands
+    such as --list-cities or a cached --format json answer never need them. The import goes
+    through importlib.import_module, whose import lock makes a thread that needs the module
+    wait for one that is still importing it. Once imported, the module's attributes are
+    copied onto the stand-in so later lookups cost no more than on the module itself.
+    """
+
+    def __init__(self, name):
+        self._lazy_name = name
+
+    def __getattr__(self, attribute):
+        module = importlib.import_module(self._lazy_name)
+        self.__dict__.update(vars(module))
+        return getattr(module, attribute)
+
+asyncio = LazyModule('asyncio')
+futures = LazyModule('concurrent.futures')
+np = LazyModule('numpy')
+pd = LazyModule('pandas')
 
 # Dictionary to map city names to their respective CSV data files
-CITY_DATA = { 
+CITY_DATA = {
     'chicago': 'chicago.csv',
     'new york city': 'new_york_city.csv',
-    'washington': 'washington.csv' 
+    'washington': 'washington.csv'
 }
 
+# Directory holding the typed columnar copies of the city files
+CACHE_DIR = '.bikeshare_cache'
+
+# Layout version of everything written to CACHE_DIR and PARTITION_DIR; bumping it
+# makes every cached copy out of date
+CACHE_VERSION = 6
+
+# Day names in weekday order, used as the categories of the day_of_week column
+DAY_NAMES = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+# Month and day filter values accepted from the user, besides "all"; a month's number
+# is its position plus one and a day's weekday code (Monday=0) is its position
+MONTHS = ['january', 'february', 'march', 'april', 'may', 'june']
+DAYS = [day.lower() for day in DAY_NAMES]
+
+# Directory holding the month/weekday partitioned copies of the city files
+PARTITION_DIR = '.bikeshare_partitions'
+
+# Number of CSV rows read at a time by the filtered scan
+SCAN_CHUNKSIZE = 200000
+
+# Largest station-pair key space counted with a dense np.bincount, and how many times the
+# number of pairs being counted it may be; sparser key spaces are counted by sorting
+PAIR_BINCOUNT_LIMIT = 1 << 24
+PAIR_BINCOUNT_DENSITY = 4
+
+# Number of most frequent routes shown by station_stats
+TOP_ROUTES = int(os.environ.get('BIKESHARE_TOP_ROUTES', 1))
+
+# np.logspace arguments of the trip duration histogram bin edges in seconds:
+# 10 log-spaced bins per factor of ten, from 1 second to about 11.5 days
+DURATION_BIN_LOGSPACE = (0, 6, 61)
+
+# Percentiles reported by duration_stats
+DURATION_PERCENTILES = (50, 90, 99)
+
+# Size of the Count-Min sketches used by approx_stats: width counters per row, depth rows,
+# and how many heavy-hitter candidates are tracked per sketch
+SKETCH_WIDTH = 1 << 16
+SKETCH_DEPTH = 4
+SKETCH_CANDIDATES = 64
+
+# Odd 64-bit multiplier used to mix integer keys into sketch hashes
+SKETCH_HASH_MIX = 0x9E3779B97F4A7C15
+
+# First and last birth year of the fixed birth year histogram kept by approx_stats
+BIRTH_YEAR_RANGE = (1880, 2029)
+
+# Memory budget (in bytes) for the parsed city frames kept between restarts
+FRAME_CACHE_BUDGET = int(os.environ.get('BIKESHARE_CACHE_MB', 2048)) * 1024 * 1024
+
+# Parsed, unfiltered city frames, least recently used first. The lock only guards the
+# dictionaries; a city being read has an Event in frame_loads that is set once it is done.
+frame_cache = OrderedDict()
+frame_cache_lock = threading.Lock()
+frame_loads = {}
+
+# Aggregate cubes already read from disk, keyed by city
+cube_cache = {}
+
+# How far into each city file the loaded frame goes, as recorded by file_mark
+frame_marks = {}
+
+# Row-offset indexes already read from disk, keyed by city
+row_index_cache = {}
+
+# Origin-destination matrices already read from disk, keyed by city
+od_cache = {}
+
+# Background threads warming a city's data while the user is still answering prompts
+prefetch_threads = {}
+
+# Number of raw rows shown per page by data_info
+PAGE_SIZE = 5
+
+# Statistics each --stats group of the command line prints, as stats_record keys
+STAT_GROUPS = {
+    'time': ['popular_month', 'popular_day', 'popular_hour'],
+    'station': ['popular_start_station', 'popular_end_station', 'top_routes', 'popular_trip'],
+    'duration': ['total_duration', 'mean_duration'],
+    'user': ['user_types', 'genders', 'common_birth_year', 'recent_birth_year', 'earliest_birth_year']
+}
+
+# File the timing spans are exported to: JSON lines, or Prometheus text if it ends in .prom.
+# Spans are only recorded when this is set.
+METRICS_PATH = os.environ.get('BIKESHARE_METRICS')
+
+# Also record the peak traced memory of every span (slows allocation-heavy code)
+TRACE_MEMORY = os.environ.get('BIKESHARE_TRACE_MEMORY') == '1'
+
+# Recorded spans not yet exported, and running per-span totals for the Prometheus export
+metrics = []
+metric_totals = {}
+metrics_lock = threading.Lock()
+span_state = threading.local()
+
+
+@contextlib.contextmanager
+def span(name, **fields):
+    """Times a block with perf_counter_ns and records it as a metric span.
+
+    The yielded dict can be filled in by the block with counters such as rows_in,
+    rows_out and bytes_read. After the block it also holds duration_ns, plus
+    peak_bytes when TRACE_MEMORY is on.
+    """
+    record = dict(fields, span=name)
+    stack = getattr(span_state, 'stack', None)
+    if stack is None:
+        stack = span_state.stack = []
+    if TRACE_MEMORY:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        # Hand the peak so far to the enclosing span before measuring this one
+        if stack:
+            stack[-1]['peak_bytes'] = max(stack[-1].get('peak_bytes', 0), tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+    stack.append(record)
+    start = time.perf_counter_ns()
+    try:
+        yield record
+    finally:
+        record['duration_ns'] = time.perf_counter_ns() - start
+        stack.pop()
+        if TRACE_MEMORY:
+            record['peak_bytes'] = max(record.get('peak_bytes', 0), tracemalloc.get_traced_memory()[1])
+            if stack:
+                stack[-1]['peak_bytes'] = max(stack[-1].get('peak_bytes', 0), record['peak_bytes'])
+        if METRICS_PATH:
+            record['time'] = time.time()
+            with metrics_lock:
+                metrics.append(record)
+                totals = metric_totals.setdefault(name, {'count': 0, 'duration_ns': 0, 'rows_in': 0,
+                                                         'rows_out': 0, 'bytes_read': 0, 'peak_bytes': 0})
+                totals['count'] += 1
+                for key in ['duration_ns', 'rows_in', 'rows_out', 'bytes_read']:
+                    totals[key] += record.get(key, 0)
+                totals['peak_bytes'] = max(totals['peak_bytes'], record.get('peak_bytes', 0))
+
+def export_metrics(path=None):
+    """Writes the recorded spans to path (default METRICS_PATH).
+
+    A .prom path is rewritten with per-span totals in the Prometheus text format; any
+    other path gets the spans recorded since the last export appended as JSON lines.
+    """
+    path = path or METRICS_PATH
+    if not path:
+        return
+    with metrics_lock:
+        pending = metrics[:]
+        del metrics[:]
+        totals = {name: dict(values) for name, values in metric_totals.items()}
+
+    if path.endswith('.prom'):
+        lines = []
+        for metric, key, scale, kind in [('bikeshare_span_seconds_total', 'duration_ns', 1e-9, 'counter'),
+                                         ('bikeshare_span_count_total', 'count', 1, 'counter'),
+                                         ('bikeshare_span_rows_in_total', 'rows_in', 1, 'counter'),
+                                         ('bikeshare_span_rows_out_total', 'rows_out', 1, 'counter'),
+                                         ('bikeshare_span_bytes_read_total', 'bytes_read', 1, 'counter'),
+                                         ('bikeshare_span_peak_bytes', 'peak_bytes', 1, 'gauge')]:
+            lines.append('# TYPE %s %s' % (metric, kind))
+            for name in sorted(totals):
+                lines.append('%s{span="%s"} %s' % (metric, name, repr(totals[name][key] * scale)))
+        with open(path + '.tmp', 'w') as metrics_file:
+            metrics_file.write('\n'.join(lines) + '\n')
+        os.replace(path + '.tmp', path)
+    elif pending:
+        with open(path, 'a') as metrics_file:
+            for record in pending:
+                metrics_file.write(json.dumps(record, default=str) + '\n')
+
+if METRICS_PATH:
+    atexit.register(export_metrics)
+
+
+def correct_input(prompt, valid_inputs):
+    """Check the correctness of the user input based on the expected valid inputs.
+
+    Args:
+        prompt (str): The prompt message for user input.
+        valid_inputs (list): List of valid input options.
+
+    Returns:
+        str: Validated user input.
+    """
+    while True:
+        line_input = input(prompt).lower()
+        if line_input in valid_inputs:
+            return line_input
+        else:
+            print(f"Please enter one of the following: {', '.join(valid_inputs)}")
+
+def get_filters():
+    """Asks the user to specify a city, month, and day to analyze.
+
+    Returns:
+        (str) city - name of the city to analyze
+        (str) month - name of the month to filter by, or "all" to apply no month filter
+        (str) day - name of the day of week to filter by, or "all" to apply no day filter
+    """
+    print('Hello! Let\'s explore some US bikeshare data!')
+
+    city = correct_input("Enter a city (chicago, new york city, washington): ", ['chicago', 'new york city', 'washington'])
+    prefetch_city(city)  # Start loading while the month and day are asked
+    month = correct_input("Enter a month (january, february, march, april, may, june, or all): ", MONTHS + ['all'])
+    day = correct_input("Enter a day (sunday, monday, tuesday, wednesday, thursday, friday, saturday, or all): ",
+                        DAYS + ['all'])
+
+    print('-'*40)
+    return city, month, day
+
+def filter_codes(month, day):
+    """Returns the month number (1-12) and weekday code (Monday=0) of a filter, None for "all"."""
+    month_idx = None if month == 'all' else MONTHS.index(month) + 1
+    weekday_idx = None if day == 'all' else DAYS.index(day)
+    return month_idx, weekday_idx
+
+def parse_timestamps(values):
+    """Parses 'YYYY-MM-DD HH:MM:SS' strings in one vectorized pass over their bytes.
+
+    The strings are viewed as a (rows, 20) uint8 matrix and the digits are combined
+    column-wise, so no per-row Python or dateutil work is done.
+
+    Args:
+        values - array-like of timestamp strings
+
+    Returns:
+        (tuple) datetime64[ns] array and int8 month, weekday (Monday=0) and hour arrays,
+            or None if any value is not in the fixed layout
+    """
+    try:
+        raw = np.asarray(values, dtype=object).astype('S20')
+    except (TypeError, ValueError, UnicodeEncodeError):
+        return None
+    chars = raw.view(np.uint8).reshape(len(raw), 20)
+
+    # Every value must be exactly 19 bytes long with digits and separators in place;
+    # subtracting '0' wraps non-digits around to values above 9
+    digits = chars[:, [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18]] - np.uint8(ord('0'))
+    if not ((chars[:, 19] == 0).all() and (digits <= 9).all()
+            and (chars[:, 4] == ord('-')).all() and (chars[:, 7] == ord('-')).all()
+            and (chars[:, 10] == ord(' ')).all()
+            and (chars[:, 13] == ord(':')).all() and (chars[:, 16] == ord(':')).all()):
+        return None
+    digits = digits.astype(np.int32)
+
+    year = digits[:, 0] * 1000 + digits[:, 1] * 100 + digits[:, 2] * 10 + digits[:, 3]
+    month, day = digits[:, 4] * 10 + digits[:, 5], digits[:, 6] * 10 + digits[:, 7]
+    hour, minute = digits[:, 8] * 10 + digits[:, 9], digits[:, 10] * 10 + digits[:, 11]
+    second = digits[:, 12] * 10 + digits[:, 13]
+    if not ((month >= 1) & (month <= 12) & (hour <= 23) & (minute <= 59) & (second <= 59)).all():
+        return None
+
+    months_since_epoch = ((year - 1970) * 12 + month - 1).astype('datetime64[M]')
+    month_starts = months_since_epoch.astype('datetime64[D]').astype(np.int64)
+    # The day must exist in its month (2017-02-30 is left for pandas to reject)
+    days_in_month = (months_since_epoch + 1).astype('datetime64[D]').astype(np.int64) - month_starts
+    if not ((day >= 1) & (day <= days_in_month)).all():
+        return None
+    days = month_starts + day - 1
+    seconds = days * 86400 + (hour * 3600 + minute * 60 + second)
+    # 1970-01-01 was a Thursday, weekday 3
+    weekday = (days + 3) % 7
+    return (seconds.astype('datetime64[s]').astype('datetime64[ns]'),
+            month.astype(np.int8), weekday.astype(np.int8), hour.astype(np.int8))
+
+def add_time_columns(df):
+    """Parses the timestamp columns in place and adds the int8 month/hour and categorical day_of_week columns."""
+    parsed = parse_timestamps(df['Start Time'])
+    if parsed is None:
+        # Fall back to pandas for values that are not in the usual fixed layout; a missing
+        # timestamp gets the -1 code, which the statistics skip like any missing value
+        df['Start Time'] = pd.to_datetime(df['Start Time'])
+        month = df['Start Time'].dt.month.fillna(-1).astype('int8')
+        weekday = df['Start Time'].dt.weekday.fillna(-1).astype('int8')
+        hour = df['Start Time'].dt.hour.fillna(-1).astype('int8')
+    else:
+        start_time, month, weekday, hour = parsed
+        df['Start Time'] = start_time
+    df['month'] = month
+    df['day_of_week'] = pd.Categorical.from_codes(weekday, DAY_NAMES)
+    df['hour'] = hour
+
+    if 'End Time' in df.columns:
+        parsed = parse_timestamps(df['End Time'])
+        df['End Time'] = pd.to_datetime(df['End Time']) if parsed is None else parsed[0]
+    return df
+
+def station_dictionary(city, names=()):
+    """Returns the station dictionary of a city, adding any station names it does not know yet.
+
+    The dictionary is stored in CACHE_DIR and only ever grows at the end, so a station keeps
+    the same code across sessions and across the Start and End Station columns.
+
+    Args:
+        (str) city - name of the city
+        names - station names that must be in the dictionary
+
+    Returns:
+        (list) station names, indexed by station code
+    """
+    path = os.path.join(CACHE_DIR, os.path.splitext(os.path.basename(CITY_DATA[city]))[0] + '.stations.json')
+    try:
+        with open(path) as dictionary_file:
+            stations = json.load(dictionary_file)
+    except (OSError, ValueError):
+        stations = []
+
+    known = set(stations)
+    new_names = sorted(set(name for name in names if isinstance(name, str)) - known)
+    if new_names:
+        stations.extend(new_names)
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            with open(path + '.tmp', 'w') as dictionary_file:
+                json.dump(stations, dictionary_file)
+            os.replace(path + '.tmp', path)
+        except OSError:
+            # Codes then only stay stable for this session
+            pass
+    return stations
+
+def encode_columns(df, city):
+    """Stores the repetitive text columns of df as categories.
+
+    Both station columns share the city's station dictionary; 'User Type', 'Gender' and
+    'day_of_week' get small categories of their own.
+    """
+    station_columns = [column for column in ['Start Station', 'End Station'] if column in df.columns]
+    if station_columns:
+        names = pd.unique(pd.concat([df[column].astype(object) for column in station_columns]).dropna())
+        stations = pd.CategoricalDtype(station_dictionary(city, names))
+        for column in station_columns:
+            df[column] = df[column].astype(object).astype(stations)
+    for column in ['User Type', 'Gender']:
+        if column in df.columns:
+            df[column] = df[column].astype(object).astype('category')
+    if 'day_of_week' in df.columns:
+        df['day_of_week'] = df['day_of_week'].astype(pd.CategoricalDtype(DAY_NAMES))
+    return df
+
+def parse_city_csv(city):
+    """Reads a city CSV file and adds the typed columns used by the statistics.
+
+    Args:
+        (str) city - name of the city to read
+
+    Returns:
+        df - Pandas DataFrame with parsed timestamps, int8 month/hour columns and categorical text columns
+    """
+    with span('read_csv', city=city) as record:
+        df = pd.read_csv(CITY_DATA[city])
+        record['bytes_read'] = os.path.getsize(CITY_DATA[city])
+        record['rows_out'] = len(df)
+    with span('parse_times', city=city, rows_in=len(df)):
+        add_time_columns(df)
+    with span('encode_columns', city=city, rows_in=len(df)):
+        return encode_columns(df, city)
+
+def cache_path(city):
+    """Returns the path of the header of a city's column store."""
+    return os.path.join(CACHE_DIR, os.path.basename(CITY_DATA[city]) + '.columns.json')
+
+def source_signature(filename):
+    """Returns the (cache version, mtime, size) triple used to detect a changed city file."""
+    stat = os.stat(filename)
+    return CACHE_VERSION, stat.st_mtime_ns, stat.st_size
+
+def file_mark(filename, offset=None):
+    """Records how far into a file the data has been read.
+
+    Returns:
+        (dict) the byte offset read up to (default: the whole file) and the bytes just
+            before it, which appended_since uses to tell an append from a rewrite
+    """
+    if offset is None:
+        offset = os.path.getsize(filename)
+    with open(filename, 'rb') as source:
+        source.seek(max(offset - 64, 0))
+        tail = source.read(offset - max(offset - 64, 0))
+    return {'bytes': offset, 'tail': tail.hex()}
+
+def appended_since(filename, mark):
+    """Returns True if the file still starts with the data that mark was taken from."""
+    if not mark or os.path.getsize(filename) < mark['bytes']:
+        return False
+    return file_mark(filename, mark['bytes'])['tail'] == mark['tail']
+
+def append_frames(old, new, city):
+    """Concatenates two city frames, keeping the categorical columns categorical.
+
+    Both station columns are put on the city's station dictionary, as encode_columns does.
+    Other categories that only occur in the new rows are added after the old ones, so the
+    codes of the old rows stay the same.
+    """
+    new = new.copy()
+    station_columns = [column for column in ['Start Station', 'End Station']
+                       if column in old.columns and column in new.columns]
+    if station_columns:
+        names = pd.unique(pd.concat([new[column].astype(object) for column in station_columns]).dropna())
+        stations = pd.CategoricalDtype(station_dictionary(city, names))
+    old_columns = {}
+    for column in old.columns:
+        if column in station_columns:
+            old_columns[column] = old[column].cat.set_categories(stations.categories)
+        elif isinstance(old[column].dtype, pd.CategoricalDtype) and column in new.columns:
+            extra = pd.Index(pd.unique(new[column].dropna().astype(object))).difference(old[column].cat.categories)
+            old_columns[column] = old[column].cat.add_categories(extra) if len(extra) else old[column]
+        else:
+            continue
+        new[column] = new[column].astype(object).astype(old_columns[column].dtype)
+    if old_columns:
+        old = old.assign(**old_columns)
+    return pd.concat([old, new], ignore_index=True)
+
+def parse_appended_rows(city, mark):
+    """Parses only the rows appended to a city file after mark.
+
+    Returns:
+        df - Pandas DataFrame of the new rows, typed like parse_city_csv
+    """
+    filename = CITY_DATA[city]
+    with span('read_csv_tail', city=city) as record, open(filename, 'rb') as source:
+        header = source.readline()
+        source.seek(mark['bytes'])
+        new_bytes = source.read()
+        record['bytes_read'] = len(new_bytes)
+        df = pd.read_csv(io.BytesIO(header + new_bytes.lstrip(b'\r\n')))
+        record['rows_out'] = len(df)
+    add_time_columns(df)
+    return encode_columns(df, city)
+
+def write_city_cache(city, entry):
+    """Writes a city frame to its column store; failures are ignored.
+
+    Every column is saved as a fixed-layout .npy file (categorical columns as their integer
+    codes) and described in a JSON header together with the source signature and mark.
+    New column files get fresh names and the header is replaced last, so a reader always
+    sees one complete set of files. Afterwards every column file of the city that the new
+    header does not list is removed; processes that still map one keep their mapping.
+    Callers hold city_build_lock, so no other generation can be half written.
+    """
+    path = cache_path(city)
+    basename = os.path.basename(CITY_DATA[city])
+    prefix = '%s.%d-%d.' % (basename, os.getpid(), time.time_ns())
+
+    df = entry['df']
+    columns = []
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        for position, (name, series) in enumerate(df.items()):
+            column = {'name': name, 'file': prefix + '%d.npy' % position}
+            if isinstance(series.dtype, pd.CategoricalDtype):
+                values = series.array.codes
+                column['categories'] = series.cat.categories.tolist()
+            elif series.dtype == object:
+                # Leftover text columns are stored coded too, and turned back into objects on reading
+                values, uniques = pd.factorize(series)
+                column['objects'] = uniques.tolist()
+            else:
+                values = series.to_numpy()
+            np.save(os.path.join(CACHE_DIR, column['file']), values, allow_pickle=False)
+            columns.append(column)
+
+        header = {'signature': list(entry['signature']), 'mark': entry['mark'], 'rows': len(df), 'columns': columns}
+        with open(path + '.tmp', 'w') as header_file:
+            json.dump(header, header_file)
+        os.replace(path + '.tmp', path)
+        generation_file = re.compile(re.escape(basename) + r'\.\d+-\d+\.\d+\.npy$')
+        keep = set(column['file'] for column in columns)
+        stale_files = [name for name in os.listdir(CACHE_DIR) if generation_file.match(name) and name not in keep]
+    except (OSError, ValueError, TypeError):
+        # The cache is only an optimisation, so a read-only disk (or a column that
+        # cannot be stored this way) is not an error
+        stale_files = [column['file'] for column in columns]
+
+    for name in stale_files:
+        try:
+            os.remove(os.path.join(CACHE_DIR, name))
+        except OSError:
+            pass
+
+@contextlib.contextmanager
+def city_build_lock(city):
+    """Holds an exclusive, cross-process lock on a city's column store while the block runs.
+
+    Only one process at a time parses a city and writes its store; the others wait and
+    then read what it wrote. Without fcntl or a writable CACHE_DIR the block runs unlocked.
+    """
+    lock_file = None
+    if fcntl is not None:
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            lock_file = open(os.path.join(CACHE_DIR, os.path.basename(CITY_DATA[city]) + '.lock'), 'a')
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        except OSError:
+            if lock_file is not None:
+                lock_file.close()
+            lock_file = None
+    try:
+        yield
+    finally:
+        if lock_file is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+
+def read_city_cache(city):
+    """Opens a city's column store, memory-mapping every column file read-only.
+
+    The returned frame is built on the mappings without copying them, so concurrent
+    sessions on the same city share one copy in the page cache.
+
+    Returns:
+        (dict) the 'signature' and 'mark' the store was written with, and the frame as 'df'
+    """
+    with open(cache_path(city)) as header_file:
+        header = json.load(header_file)
+    columns = {}
+    for column in header['columns']:
+        values = np.load(os.path.join(CACHE_DIR, column['file']), mmap_mode='r', allow_pickle=False)
+        if len(values) != header['rows']:
+            raise ValueError('column %r has %d rows, not %d' % (column['name'], len(values), header['rows']))
+        if 'categories' in column:
+            values = pd.Categorical.from_codes(values, categories=column['categories'])
+        elif 'objects' in column:
+            values = pd.Categorical.from_codes(values, categories=column['objects']).astype(object)
+        columns[column['name']] = values
+    return {'signature': tuple(header['signature']), 'mark': header['mark'],
+            'df': pd.DataFrame(columns, copy=False)}
+
+def city_cache_current(city):
+    """Returns whether the column store of a city was written from the current city file."""
+    try:
+        with open(cache_path(city)) as header_file:
+            return tuple(json.load(header_file)['signature']) == source_signature(CITY_DATA[city])
+    except (OSError, ValueError, KeyError):
+        return False
+
+def load_city_cache(city):
+    """Returns the column store of a city as read_city_cache does, or None if it is missing or broken."""
+    if not os.path.exists(cache_path(city)):
+        return None
+    try:
+        with span('read_cache', city=city) as record:
+            cached = read_city_cache(city)
+            record['rows_out'] = len(cached['df'])
+        return cached
+    except (OSError, ValueError, KeyError, TypeError):
+        # A broken store, or one replaced while it was being opened, is read again or
+        # rebuilt under the city's build lock
+        return None
+
+def read_city(city):
+    """Reads the full, unfiltered data for a city through the columnar cache.
+
+    The first read parses the CSV and writes a typed copy to CACHE_DIR. Later reads
+    memory-map that copy as long as the source file's mtime and size have not changed.
+    If rows were only appended to the file since then, just those rows are parsed
+    and added to the copy. Parsing and writing happen under city_build_lock, so
+    concurrent processes parse a city once between them.
+
+    Args:
+        (str) city - name of the city to read
+
+    Returns:
+        df - Pandas DataFrame containing all the city data
+    """
+    filename = CITY_DATA[city]
+    cached = load_city_cache(city)
+    if cached is not None and cached['signature'] == source_signature(filename):
+        frame_marks[city] = cached['mark']
+        return cached['df']
+
+    with city_build_lock(city):
+        # Another process may have written the store while this one waited for the lock
+        cached = load_city_cache(city)
+        signature = source_signature(filename)
+        if cached is not None and cached['signature'] == signature:
+            frame_marks[city] = cached['mark']
+            return cached['df']
+
+        if cached is not None and appended_since(filename, cached.get('mark')):
+            mark = file_mark(filename)
+            df = append_frames(cached['df'], parse_appended_rows(city, cached['mark']), city)
+        else:
+            mark = file_mark(filename)
+            df = parse_city_csv(city)
+
+        write_city_cache(city, {'signature': signature, 'mark': mark, 'df': df})
+    frame_marks[city] = mark
+    return df
+
+def get_city_frame(city, speculative=False):
+    """Returns the unfiltered data for a city, keeping it in memory for later restarts.
+
+    Frames are evicted least recently used first once FRAME_CACHE_BUDGET is exceeded.
+    The most recently requested city is always kept, even if it is larger than the budget.
+    A city is read by one thread at a time; other threads asking for the same city wait
+    for that read, while cities already in memory are returned straight away.
+
+    Args:
+        (str) city - name of the city to read
+        (bool) speculative - the city is only being warmed in case it is asked for: its frame
+            is kept as least recently used and only if it fits without evicting another city
+
+    Returns:
+        df - Pandas DataFrame containing all the city data
+    """
+    signature = source_signature(CITY_DATA[city])
+    while True:
+        with frame_cache_lock:
+            if city in frame_cache:
+                cached_signature, df, _ = frame_cache[city]
+                if cached_signature == signature:
+                    if not speculative:
+                        frame_cache.move_to_end(city)
+                    return df
+                del frame_cache[city]
+            loading = frame_loads.get(city)
+            if loading is None:
+                loading = frame_loads[city] = threading.Event()
+                break
+        # Another thread is reading this city; use its frame (or read it here if that failed)
+        loading.wait()
+
+    try:
+        df = read_city(city)
+        size = int(df.memory_usage(deep=True).sum())
+        with frame_cache_lock:
+            if speculative:
+                if sum(entry[2] for entry in frame_cache.values()) + size <= FRAME_CACHE_BUDGET:
+                    frame_cache[city] = (signature, df, size)
+                    frame_cache.move_to_end(city, last=False)
+            else:
+                frame_cache[city] = (signature, df, size)
+                # Evict the least recently used cities until the budget is met
+                while len(frame_cache) > 1 and sum(entry[2] for entry in frame_cache.values()) > FRAME_CACHE_BUDGET:
+                    frame_cache.popitem(last=False)
+    finally:
+        with frame_cache_lock:
+            del frame_loads[city]
+        loading.set()
+    return df
+
+def warm_city(city, speculative=False):
+    """Loads whatever get_stats will need for a city: its aggregate cube, or else its frame."""
+    with span('prefetch', city=city):
+        try:
+            if read_cube(city) is None:
+                get_city_frame(city, speculative)
+        except Exception:
+            # Only a head start: the foreground load will hit and report the same error
+            pass
+
+def prefetch_city(city, speculative=False):
+    """Starts warming a city's data on a background thread, unless it is already being warmed.
+
+    The threads are daemons, so quitting never waits for a load, and a foreground
+    get_city_frame of the same city waits for the one in progress instead of parsing
+    the file a second time. Speculative warm-ups never evict another city's frame.
+    """
+    thread = prefetch_threads.get(city)
+    if thread is not None and thread.is_alive():
+        return
+    thread = threading.Thread(target=warm_city, args=(city, speculative), name='prefetch-' + city, daemon=True)
+    prefetch_threads[city] = thread
+    thread.start()
+
+def filtered_chunks(city, month, day, usecols=None, chunksize=None):
+    """Yields the rows of a city file that match the month and day filters, chunk by chunk.
+
+    The month filter is applied to the raw 'YYYY-MM-DD' text before any timestamp parsing,
+    so rows from other months are dropped without being parsed.
+
+    Args:
+        (str) city - name of the city to analyze
+        (str) month - name of the month to filter by, or "all" to apply no month filter
+        (str) day - name of the day of week to filter by, or "all" to apply no day filter
+        usecols - CSV columns to read, as accepted by pd.read_csv, or None for every column
+        (int) chunksize - rows read at a time, or None for SCAN_CHUNKSIZE
+    """
+    month_idx, weekday_idx = filter_codes(month, day)
+    for chunk in pd.read_csv(CITY_DATA[city], usecols=usecols, chunksize=chunksize or SCAN_CHUNKSIZE):
+        # Filter on the month digits of the raw timestamp text before parsing it
+        if month_idx is not None:
+            chunk = chunk[chunk['Start Time'].str.slice(5, 7).astype('int8') == month_idx]
+        if chunk.empty:
+            continue
+        add_time_columns(chunk)
+        if weekday_idx is not None:
+            chunk = chunk[chunk['day_of_week'] == DAY_NAMES[weekday_idx]]
+        yield chunk
+
+def scan_data(city, month, day, columns=None):
+    """Reads only the rows and columns of a city file that a query needs.
+
+    The CSV is read in chunks of SCAN_CHUNKSIZE rows and filtered chunk by chunk, so
+    only the matching rows of the requested columns are kept in memory.
+
+    Args:
+        (str) city - name of the city to analyze
+        (str) month - name of the month to filter by, or "all" to apply no month filter
+        (str) day - name of the day of week to filter by, or "all" to apply no day filter
+        (list) columns - CSV columns to keep, or None to keep every column
+
+    Returns:
+        df - Pandas DataFrame containing the requested columns of the matching rows
+    """
+    usecols = None
+    if columns is not None:
+        usecols = list(dict.fromkeys(['Start Time'] + list(columns)))
+
+    # Chunks keep the row numbers of the file as their index, like a filtered read_city frame
+    chunks = list(filtered_chunks(city, month, day, usecols))
+    if chunks:
+        df = pd.concat(chunks)
+    else:
+        df = add_time_columns(pd.read_csv(CITY_DATA[city], usecols=usecols, nrows=0))
+    return encode_columns(df, city)
+
+def partition_paths(city):
+    """Returns the (data file, manifest file) paths of the partitioned layout of a city."""
+    name = os.path.join(PARTITION_DIR, os.path.splitext(os.path.basename(CITY_DATA[city]))[0])
+    return name + '.parts', name + '.json'
+
+def write_partitions(data_file, df):
+    """Appends the (month, weekday) partitions of df to an open data file.
+
+    Returns:
+        (list) the manifest entries of the partitions that were written
+    """
+    partitions = []
+    weekday = df['day_of_week'].cat.codes
+    for (month_idx, weekday_idx), part in df.groupby([df['month'], weekday], sort=True):
+        offset = data_file.tell()
+        pickle.dump(part, data_file, protocol=pickle.HIGHEST_PROTOCOL)
+        partitions.append({'month': int(month_idx), 'weekday': int(weekday_idx), 'rows': len(part),
+                           'offset': offset, 'length': data_file.tell() - offset})
+    return partitions
+
+def write_manifest(city, manifest):
+    """Writes the partition manifest of a city."""
+    manifest_path = partition_paths(city)[1]
+    with open(manifest_path + '.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+def ingest_city(city):
+    """Rewrites a city file into partitions keyed by month and weekday.
+
+    Each partition is pickled and appended to one data file; a JSON manifest records the
+    row count, byte offset and byte length of every partition plus the source file's
+    signature, so load_partitions can seek straight to the partitions a query needs.
+
+    Args:
+        (str) city - name of the city to ingest
+
+    Returns:
+        (dict) the manifest that was written
+    """
+    signature = source_signature(CITY_DATA[city])
+    df = read_city(city)
+    data_path = partition_paths(city)[0]
+    os.makedirs(PARTITION_DIR, exist_ok=True)
+
+    with open(data_path + '.tmp', 'wb') as data_file:
+        partitions = write_partitions(data_file, df)
+    os.replace(data_path + '.tmp', data_path)
+
+    manifest = {'signature': list(signature), 'mark': frame_marks[city], 'rows': len(df),
+                'columns': list(df.columns), 'partitions': partitions}
+    write_manifest(city, manifest)
+    return manifest
+
+def read_manifest(city):
+    """Returns the partition manifest of a city, or None if it is missing or out of date."""
+    manifest_path = partition_paths(city)[1]
+    try:
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        return None
+    if tuple(manifest.get('signature', ())) != source_signature(CITY_DATA[city]):
+        return None
+    return manifest
+
+def load_partitions(city, month, day, manifest):
+    """Loads only the partitions of a city that match the month and day filters.
+
+    Args:
+        (str) city - name of the city to analyze
+        (str) month - name of the month to filter by, or "all" to apply no month filter
+        (str) day - name of the day of week to filter by, or "all" to apply no day filter
+        (dict) manifest - the city's partition manifest, as returned by read_manifest
+
+    Returns:
+        df - Pandas DataFrame containing city data filtered by month and day
+    """
+    month_idx, weekday_idx = filter_codes(month, day)
+
+    parts = []
+    with span('read_partitions', city=city) as record, open(partition_paths(city)[0], 'rb') as data_file:
+        record['bytes_read'] = 0
+        for entry in manifest['partitions']:
+            if month_idx is not None and entry['month'] != month_idx:
+                continue
+            if weekday_idx is not None and entry['weekday'] != weekday_idx:
+                continue
+            data_file.seek(entry['offset'])
+            parts.append(pickle.loads(data_file.read(entry['length'])))
+            record['bytes_read'] += entry['length']
+        record['rows_out'] = sum(len(part) for part in parts)
+
+    if not parts:
+        return read_city(city).iloc[0:0]
+    # Partitions are stored in (month, weekday) order, so restore the file order of the rows
+    df = pd.concat(parts).sort_index()
+    return encode_columns(df, city)
+
+def load_data(city, month, day):
+    """Loads data for the specified city and filters by month and day if applicable.
+
+    Args:
+        (str) city - name of the city to analyze
+        (str) month - name of the month to filter by, or "all" to apply no month filter
+        (str) day - name of the day of week to filter by, or "all" to apply no day filter
+
+    Returns:
+        df - Pandas DataFrame containing city data filtered by month and day
+    """
+    with span('load_data', city=city, month=month, day=day) as record:
+        # A partitioned copy lets a selective query read only its own slice, unless the
+        # whole city is already in memory and a mask is cheaper. Without either, a current
+        # column store or a load in progress, the scan parses only the matching rows
+        if (month != 'all' or day != 'all') and city not in frame_cache:
+            manifest = read_manifest(city)
+            if manifest is not None:
+                df = load_partitions(city, month, day, manifest)
+            elif not city_cache_current(city) and city not in frame_loads:
+                df = scan_data(city, month, day)
+                # Build the column store behind the scan, so the next query can use it
+                prefetch_city(city)
+            else:
+                df = None
+            if df is not None:
+                record['rows_out'] = len(df)
+                return df
+
+        df = get_city_frame(city)
+
+        # Filter the DataFrame based on month and day
+        with span('filter', city=city, rows_in=len(df)) as filter_record:
+            month_idx, weekday_idx = filter_codes(month, day)
+            if month_idx is not None:
+                df = df[df['month'] == month_idx]
+
+            if weekday_idx is not None:
+                df = df[df['day_of_week'] == DAY_NAMES[weekday_idx]]
+            filter_record['rows_out'] = record['rows_out'] = len(df)
+
+    return df
+
+def column_codes(series, labels=None):
+    """Returns (codes, labels) for a column, with -1 codes for missing values.
+
+    Categorical columns reuse their codes; other columns are factorized with sorted labels.
+    If labels is given, the column is coded against those labels instead.
+    """
+    if labels is not None:
+        if isinstance(series.dtype, pd.CategoricalDtype) and np.array_equal(series.cat.categories, labels):
+            return np.asarray(series.cat.codes), labels
+        return np.asarray(pd.Categorical(series, categories=labels).codes), labels
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return np.asarray(series.cat.codes), np.asarray(series.cat.categories)
+    codes, labels = pd.factorize(series, sort=True)
+    return codes, np.asarray(labels)
+
+def station_labels(df):
+    """Returns every station named by either station column of a city frame.
+
+    Both columns normally share the city's station dictionary; otherwise the stations only
+    found in 'End Station' follow the 'Start Station' categories.
+    """
+    labels = df['Start Station'].cat.categories
+    return np.asarray(labels.append(df['End Station'].cat.categories.difference(labels)), dtype=object)
+
+def recode_map(categories, labels):
+    """Returns an array mapping codes into categories to codes into labels, where -1 stays -1."""
+    return np.append(pd.Index(labels).get_indexer(categories), -1)
+
+def count_codes(codes, size):
+    """Counts how often each code in range(size) appears, ignoring missing (-1) codes."""
+    codes = codes[codes >= 0]
+    return np.bincount(codes, minlength=size)
+
+def mode_label(counts, labels):
+    """Returns the most common label (the lowest one on ties), or None if nothing was counted."""
+    if len(counts) == 0 or counts.max() == 0:
+        return None
+    return min(labels[np.flatnonzero(counts == counts.max())])
+
+def value_counts_from(counts, labels, name):
+    """Builds the Series that Series.value_counts() would print from a counts array."""
+    counts_series = pd.Series(counts, index=pd.Index(labels, name=name), name='count')
+    return counts_series[counts_series > 0].sort_values(ascending=False, kind='stable')
+
+def count_pairs(start_codes, end_codes, start_size, end_size):
+    """Counts (start, end) station pairs packed into single int64 keys.
+
+    The key of a pair is start_code * end_size + end_code. Key spaces that are small, both
+    absolutely and next to the number of pairs, are counted with one dense np.bincount;
+    otherwise the keys are sorted, so a small slice never allocates every possible pair.
+
+    Returns:
+        (array) keys - the distinct pair keys, in increasing order
+        (array) counts - the number of trips for each key
+    """
+    valid = (start_codes >= 0) & (end_codes >= 0)
+    pair_keys = start_codes[valid].astype(np.int64) * end_size + end_codes[valid]
+    key_space = start_size * end_size
+    if key_space <= PAIR_BINCOUNT_LIMIT and key_space <= PAIR_BINCOUNT_DENSITY * len(pair_keys):
+        dense = np.bincount(pair_keys, minlength=start_size * end_size)
+        keys = np.flatnonzero(dense)
+        return keys, dense[keys]
+    return np.unique(pair_keys, return_counts=True)
+
+def top_pairs(keys, counts, n):
+    """Returns the indexes of the n largest counts, most trips first (lowest key on ties).
+
+    np.argpartition picks the candidates without sorting every pair; only those n are sorted.
+    """
+    if n <= 0 or len(counts) == 0:
+        return np.empty(0, dtype=np.int64)
+    if n < len(counts):
+        # Keep every pair tied with the n-th count so ties resolve by key, not partition order
+        threshold = counts[np.argpartition(counts, len(counts) - n)[len(counts) - n]]
+        candidates = np.flatnonzero(counts >= threshold)
+    else:
+        candidates = np.arange(len(counts))
+    order = np.lexsort((keys[candidates], -counts[candidates]))
+    return candidates[order[:n]]
+
+def encode_frame(df, labels=None):
+    """Turns every column the statistics use into integer codes.
+
+    Args:
+        df - Pandas DataFrame containing city data
+        (dict) labels - labels to code against, or None to take them from df
+
+    Returns:
+        (dict) codes - integer code arrays keyed by column
+        (dict) labels - the labels behind the station, user type and gender codes,
+            plus the first birth year, which is code 0 of 'birth_year'
+    """
+    if labels is None:
+        labels = {}
+    codes = {'month': np.asarray(df['month'], dtype=np.int64),
+             'weekday': np.asarray(df['day_of_week'].cat.codes, dtype=np.int64),
+             'hour': np.asarray(df['hour'], dtype=np.int64),
+             'duration': np.asarray(df['Trip Duration'], dtype=np.float64)}
+    codes['start'], start_labels = column_codes(df['Start Station'], labels.get('start'))
+    codes['end'], end_labels = column_codes(df['End Station'], labels.get('end'))
+    codes['user_type'], user_labels = column_codes(df['User Type'], labels.get('user_types'))
+    new_labels = {'start': start_labels, 'end': end_labels, 'user_types': user_labels,
+                  'genders': None, 'first_year': 0, 'year_span': 0}
+
+    if 'Gender' in df.columns:
+        codes['gender'], new_labels['genders'] = column_codes(df['Gender'], labels.get('genders'))
+        years = np.asarray(df['Birth Year'], dtype=np.float64)
+        known = ~np.isnan(years)
+        if 'first_year' in labels:
+            new_labels['first_year'], new_labels['year_span'] = labels['first_year'], labels['year_span']
+        elif known.any():
+            new_labels['first_year'] = int(years[known].min())
+            new_labels['year_span'] = int(years[known].max()) - new_labels['first_year'] + 1
+        year_codes = np.full(len(years), -1, dtype=np.int64)
+        year_codes[known] = years[known].astype(np.int64) - new_labels['first_year']
+        year_codes[(year_codes < 0) | (year_codes >= new_labels['year_span'])] = -1
+        codes['birth_year'] = year_codes
+    return codes, new_labels
+
+def aggregate(codes, labels):
+    """Counts everything the statistics need from coded columns.
+
+    The result only holds counts, sums, minimums and maximums, so aggregates of
+    disjoint sets of rows can be combined with merge_aggregates.
+    """
+    agg = {'rows': len(codes['month']),
+           'month': count_codes(codes['month'], 13),
+           'weekday': count_codes(codes['weekday'], 7),
+           'hour': count_codes(codes['hour'], 24),
+           'start': count_codes(codes['start'], len(labels['start'])),
+           'end': count_codes(codes['end'], len(labels['end'])),
+           'user_types': count_codes(codes['user_type'], len(labels['user_types']))}
+
+    agg['pair_keys'], agg['pair_counts'] = count_pairs(codes['start'], codes['end'],
+                                                       len(labels['start']), len(labels['end']))
+
+    durations = codes['duration'][~np.isnan(codes['duration'])]
+    agg['duration_sum'] = durations.sum()
+    agg['duration_count'] = len(durations)
+    agg['duration_min'] = durations.min() if len(durations) else np.nan
+    agg['duration_max'] = durations.max() if len(durations) else np.nan
+
+    if labels['genders'] is not None:
+        agg['genders'] = count_codes(codes['gender'], len(labels['genders']))
+        agg['birth_years'] = count_codes(codes['birth_year'], labels['year_span'])
+    return agg
+
+def empty_aggregate(labels):
+    """Returns the aggregate of no rows, coded against labels."""
+    empty = {column: np.empty(0, dtype=np.int64) for column in
+             ['month', 'weekday', 'hour', 'start', 'end', 'user_type', 'gender', 'birth_year']}
+    empty['duration'] = np.empty(0)
+    return aggregate(empty, labels)
+
+def merge_aggregates(aggs):
+    """Combines aggregates of disjoint sets of rows into the aggregate of all of them."""
+    merged = {}
+    for key in ['rows', 'month', 'weekday', 'hour', 'start', 'end', 'user_types',
+                'duration_sum', 'duration_count', 'genders', 'birth_years']:
+        if key in aggs[0]:
+            merged[key] = sum(agg[key] for agg in aggs)
+    merged['duration_min'] = np.nanmin([agg['duration_min'] for agg in aggs] + [np.inf])
+    merged['duration_max'] = np.nanmax([agg['duration_max'] for agg in aggs] + [-np.inf])
+
+    pair_keys, inverse = np.unique(np.concatenate([agg['pair_keys'] for agg in aggs]), return_inverse=True)
+    pair_counts = np.bincount(inverse, weights=np.concatenate([agg['pair_counts'] for agg in aggs]),
+                              minlength=len(pair_keys))
+    merged['pair_keys'], merged['pair_counts'] = pair_keys, pair_counts.astype(np.int64)
+    return merged
+
+def finish_stats(agg, labels, city=None):
+    """Turns an aggregate into the statistics printed by the *_stats functions."""
+    stats = {'rows': agg['rows']}
+
+    # Time statistics
+    stats['popular_month'] = mode_label(agg['month'], np.arange(13))
+    stats['popular_day'] = mode_label(agg['weekday'], np.array(DAY_NAMES))
+    stats['popular_hour'] = mode_label(agg['hour'], np.arange(24))
+
+    # Station statistics
+    stats['popular_start_station'] = mode_label(agg['start'], labels['start'])
+    stats['popular_end_station'] = mode_label(agg['end'], labels['end'])
+    stats['top_routes'] = []
+    for best in top_pairs(agg['pair_keys'], agg['pair_counts'], max(TOP_ROUTES, 1)):
+        start_code, end_code = divmod(int(agg['pair_keys'][best]), len(labels['end']))
+        stats['top_routes'].append((labels['start'][start_code], labels['end'][end_code], int(agg['pair_counts'][best])))
+    stats['popular_trip'] = stats['top_routes'][0] if stats['top_routes'] else None
+
+    # Trip duration statistics
+    stats['total_duration'] = agg['duration_sum']
+    stats['mean_duration'] = agg['duration_sum'] / agg['duration_count'] if agg['duration_count'] else np.nan
+
+    # User statistics
+    stats['user_types'] = value_counts_from(agg['user_types'], labels['user_types'], 'User Type')
+    if city != 'washington' and 'genders' in agg:
+        stats['genders'] = value_counts_from(agg['genders'], labels['genders'], 'Gender')
+        seen_years = np.flatnonzero(agg['birth_years'])
+        if len(seen_years):
+            first_year = float(labels['first_year'])
+            stats['common_birth_year'] = first_year + np.argmax(agg['birth_years'])
+            stats['recent_birth_year'] = first_year + seen_years[-1]
+            stats['earliest_birth_year'] = first_year + seen_years[0]
+        else:
+            stats['common_birth_year'] = stats['recent_birth_year'] = stats['earliest_birth_year'] = None
+    return stats
+
+def compute_stats(df, city=None):
+    """Computes every statistic shown by the *_stats functions in one pass over the data.
+
+    Each column is turned into integer codes once and counted with np.bincount, instead of
+    running a separate .mode(), .value_counts() or groupby over the frame for every line.
+
+    Args:
+        df - Pandas DataFrame containing city data filtered by month and day
+        (str) city - name of the city, used to skip gender and birth year for washington
+
+    Returns:
+        (dict) the statistics, keyed by the name of the value they hold
+    """
+    with span('compute_stats', city=city, rows_in=len(df)):
+        codes, labels = encode_frame(df)
+        return finish_stats(aggregate(codes, labels), labels, city)
+
+def fold_aggregate(totals, agg, labels):
+    """Adds a chunk aggregate to running totals that are keyed by label instead of code.
+
+    Chunks are coded against their own labels, so the totals keep counts in Series
+    indexed by station, user type, gender, birth year and (start, end) pair.
+    """
+    for key in ['rows', 'month', 'weekday', 'hour', 'duration_sum', 'duration_count']:
+        totals[key] = totals.get(key, 0) + agg[key]
+    totals['duration_min'] = np.nanmin([totals.get('duration_min', np.inf), agg['duration_min']])
+    totals['duration_max'] = np.nanmax([totals.get('duration_max', -np.inf), agg['duration_max']])
+
+    counted = [('start', 'start'), ('end', 'end'), ('user_types', 'user_types')]
+    if 'genders' in agg:
+        counted.append(('genders', 'genders'))
+        years = labels['first_year'] + np.arange(labels['year_span'])
+        counted.append(('birth_years', years))
+    for key, key_labels in counted:
+        if not isinstance(key_labels, np.ndarray):
+            key_labels = labels[key_labels]
+        counts = pd.Series(agg[key], index=key_labels)
+        totals[key] = totals[key].add(counts, fill_value=0) if key in totals else counts
+
+    start_codes, end_codes = np.divmod(agg['pair_keys'], len(labels['end']))
+    index = pd.MultiIndex.from_arrays([labels['start'][start_codes], labels['end'][end_codes]])
+    pairs = pd.Series(agg['pair_counts'], index=index)
+    totals['pairs'] = totals['pairs'].add(pairs, fill_value=0) if 'pairs' in totals else pairs
+    return totals
+
+def unfold_aggregate(totals):
+    """Turns label-keyed running totals back into an (aggregate, labels) pair for finish_stats."""
+    labels = {'genders': None, 'first_year': 0, 'year_span': 0}
+    agg = {key: totals[key] for key in ['rows', 'month', 'weekday', 'hour', 'duration_sum',
+                                        'duration_count', 'duration_min', 'duration_max']}
+    for key in ['start', 'end', 'user_types', 'genders']:
+        if key in totals:
+            counts = totals[key][totals[key] > 0].sort_index()
+            labels[key] = np.asarray(counts.index)
+            agg[key] = counts.to_numpy(dtype=np.int64)
+
+    if 'birth_years' in totals:
+        years = totals['birth_years'][totals['birth_years'] > 0]
+        if len(years):
+            labels['first_year'] = int(years.index.min())
+            labels['year_span'] = int(years.index.max()) - labels['first_year'] + 1
+        agg['birth_years'] = np.zeros(labels['year_span'], dtype=np.int64)
+        agg['birth_years'][years.index.astype(np.int64) - labels['first_year']] = years.to_numpy(dtype=np.int64)
+
+    pairs = totals['pairs']
+    start_codes = pd.Index(labels['start']).get_indexer(pairs.index.get_level_values(0))
+    end_codes = pd.Index(labels['end']).get_indexer(pairs.index.get_level_values(1))
+    keys = start_codes.astype(np.int64) * len(labels['end']) + end_codes
+    order = np.argsort(keys)
+    agg['pair_keys'], agg['pair_counts'] = keys[order], pairs.to_numpy(dtype=np.int64)[order]
+    return agg, labels
+
+def stream_stats(city, month, day, chunksize=None):
+    """Computes the statistics of a query without loading the whole city file.
+
+    The CSV is read in bounded chunks; each chunk is aggregated and folded into running
+    count maps, sums, minimums and maximums, so memory depends on the chunk size and the
+    number of distinct stations, not on the number of trips.
+
+    Args:
+        (str) city - name of the city to analyze
+        (str) month - name of the month to filter by, or "all" to apply no month filter
+        (str) day - name of the day of week to filter by, or "all" to apply no day filter
+        (int) chunksize - rows read at a time, or None for SCAN_CHUNKSIZE
+
+    Returns:
+        (dict) the same statistics as compute_stats on the filtered data
+    """
+    wanted = ['Start Time', 'Trip Duration', 'Start Station', 'End Station', 'User Type', 'Gender', 'Birth Year']
+    totals = {}
+    for chunk in filtered_chunks(city, month, day, lambda column: column in wanted, chunksize):
+        codes, labels = encode_frame(chunk)
+        fold_aggregate(totals, aggregate(codes, labels), labels)
+
+    if not totals:
+        # No rows matched: answer from an empty aggregate instead of reading the file again,
+        # taking from the header whether the city has gender and birth year columns
+        header = pd.read_csv(CITY_DATA[city], nrows=0).columns
+        labels = {key: np.empty(0, dtype=object) for key in ['start', 'end', 'user_types']}
+        labels.update({'genders': np.empty(0, dtype=object) if 'Gender' in header else None,
+                       'first_year': 0, 'year_span': 0})
+        return finish_stats(empty_aggregate(labels), labels, city)
+    agg, labels = unfold_aggregate(totals)
+    return finish_stats(agg, labels, city)
+
+def new_sketch(width=None, depth=None):
+    """Returns an empty Count-Min sketch with its heavy-hitter candidates.
+
+    The sketch holds depth rows of width counters; each key is counted once per row at a
+    position picked by a different multiply-shift hash, and its estimated count is the
+    smallest of those counters. Estimates never undercount, and overcount by at most
+    e / width * total with probability 1 - exp(-depth).
+    """
+    # Multiply-shift hashing needs a power-of-two width
+    width = width or SKETCH_WIDTH
+    depth = depth or SKETCH_DEPTH
+    rng = np.random.default_rng(depth * 1000003 + width)
+    return {'table': np.zeros((depth, width), dtype=np.int64), 'total': 0,
+            'multipliers': rng.integers(1, 1 << 63, depth, dtype=np.uint64) | np.uint64(1),
+            'shift': np.uint64(64 - int(width).bit_length() + 1),
+            'candidates': {}}
+
+def sketch_positions(sketch, hashes):
+    """Returns the counter position of every hash in each row of the sketch."""
+    return [((hashes * multiplier) >> sketch['shift']).astype(np.int64) for multiplier in sketch['multipliers']]
+
+def sketch_update(sketch, hashes, label_of):
+    """Counts a chunk of hashed keys and refreshes the sketch's heavy-hitter candidates.
+
+    Args:
+        (dict) sketch - the sketch made by new_sketch
+        hashes - uint64 hash of every key in the chunk
+        label_of - function returning the key at a chunk position, only called for new candidates
+    """
+    width = sketch['table'].shape[1]
+    for row, positions in enumerate(sketch_positions(sketch, hashes)):
+        sketch['table'][row] += np.bincount(positions, minlength=width)
+    sketch['total'] += len(hashes)
+
+    # Candidates are the keys with the highest estimates among the old candidates and this chunk's keys
+    distinct, first = np.unique(hashes, return_index=True)
+    old_keys = np.array(list(sketch['candidates']), dtype=np.uint64)
+    keys = np.concatenate([old_keys, distinct])
+    positions = np.concatenate([np.full(len(old_keys), -1), first])
+    keys, unique_index = np.unique(keys, return_index=True)
+    positions = positions[unique_index]
+    keep = np.argsort(-sketch_estimates(sketch, keys), kind='stable')[:SKETCH_CANDIDATES]
+    sketch['candidates'] = {int(keys[index]): sketch['candidates'][int(keys[index])] if positions[index] < 0
+                            else label_of(positions[index]) for index in keep}
+
+def sketch_estimates(sketch, hashes):
+    """Returns the estimated count of every hash: the smallest of its counters."""
+    rows = [sketch['table'][row][positions] for row, positions in enumerate(sketch_positions(sketch, hashes))]
+    return np.min(rows, axis=0) if rows else np.empty(0, dtype=np.int64)
+
+def sketch_top(sketch, n):
+    """Returns the n candidates with the highest estimated counts as (label, estimate) pairs."""
+    if not sketch['candidates']:
+        return []
+    keys = np.array(list(sketch['candidates']), dtype=np.uint64)
+    estimates = sketch_estimates(sketch, keys)
+    order = np.argsort(-estimates, kind='stable')[:n]
+    return [(sketch['candidates'][int(keys[index])], int(estimates[index])) for index in order]
+
+def sketch_error(sketch):
+    """Returns the overcount bound of a sketch's estimates and the confidence it holds with."""
+    depth, width = sketch['table'].shape
+    return int(np.ceil(np.e / width * sketch['total'])), 1 - np.exp(-depth)
+
+def approx_chunks(city, month, day, chunksize=None):
+    """Yields the rows of a query in bounded, integer-coded chunks for approx_stats.
+
+    When the city's column store is up to date, slices of its memory-mapped columns are
+    used as they are: the station columns are already codes into the city's station
+    dictionary, so no text is parsed or hashed. Otherwise the CSV file is streamed
+    through filtered_chunks and each chunk's stations are factorized.
 
-def correct_input(str_inp, runtype):
-    """Checks the correctness of the input."""
-    """Check the correctness of the user input based on the expected type.
-||||||| parent of 8ca043b (two changes)
-def correct_input(str_inp, runtype):
-    """Check the correctness of the user input based on the expected type.
-=======
-def correct_input(prompt, valid_inputs):
-    """Check the correctness of the user input based on the expected valid inputs.
->>>>>>> 8ca043b (two changes)
-    
     Args:
-        prompt (str): The prompt message for user input.
-        valid_inputs (list): List of valid input options.
-    
+        (str) city - name of the city to analyze
+        (str) month - name of the month to filter by, or "all" to apply no month filter
+        (str) day - name of the day of week to filter by, or "all" to apply no day filter
+        (int) chunksize - rows handled at a time, or None for SCAN_CHUNKSIZE
+
+    Yields:
+        (dict) 'rows', the 'month', 'weekday' and 'hour' of every row, 'start' and 'end'
+            station codes of the trips with both stations, the 'stations' those codes index
+            and their uint64 'station_hashes', 'durations', 'user_types' and 'genders'
+            counts (genders None for cities without them) and 'birth_years'
+    """
+    chunksize = chunksize or SCAN_CHUNKSIZE
+    cached = load_city_cache(city)
+    if cached is None or cached['signature'] != source_signature(CITY_DATA[city]):
+        wanted = ['Start Time', 'Trip Duration', 'Start Station', 'End Station', 'User Type', 'Gender', 'Birth Year']
+        for chunk in filtered_chunks(city, month, day, lambda column: column in wanted, chunksize):
+            trips = chunk[['Start Station', 'End Station']].dropna()
+            codes, stations = pd.factorize(pd.concat([trips['Start Station'], trips['End Station']]))
+            stations = np.asarray(stations, dtype=object)
+            yield {'rows': len(chunk), 'month': np.asarray(chunk['month']),
+                   'weekday': np.asarray(chunk['day_of_week'].cat.codes), 'hour': np.asarray(chunk['hour']),
+                   'start': codes[:len(trips)], 'end': codes[len(trips):],
+                   'stations': stations, 'station_hashes': pd.util.hash_array(stations),
+                   'durations': chunk['Trip Duration'].dropna().to_numpy(dtype=np.float64),
+                   'user_types': chunk['User Type'].value_counts(),
+                   'genders': chunk['Gender'].value_counts() if 'Gender' in chunk.columns else None,
+                   'birth_years': chunk['Birth Year'].dropna().to_numpy(dtype=np.float64)
+                   if 'Birth Year' in chunk.columns else None}
+        return
+
+    # Whole-column views of the mappings; only the rows of one slice are ever copied
+    df = cached['df']
+    stations = station_labels(df)
+    station_maps = {name: recode_map(df[column].cat.categories, stations)
+                    for name, column in [('start', 'Start Station'), ('end', 'End Station')]}
+    columns = {'month': np.asarray(df['month']), 'weekday': np.asarray(df['day_of_week'].cat.codes),
+               'hour': np.asarray(df['hour']), 'start': np.asarray(df['Start Station'].cat.codes),
+               'end': np.asarray(df['End Station'].cat.codes),
+               'durations': np.asarray(df['Trip Duration'], dtype=np.float64)}
+    user_codes, user_labels = column_codes(df['User Type'])
+    columns['user_types'] = user_codes
+    has_genders = city != 'washington' and 'Gender' in df.columns
+    if has_genders:
+        columns['genders'], gender_labels = column_codes(df['Gender'])
+        columns['birth_years'] = np.asarray(df['Birth Year'], dtype=np.float64)
+    # Codes index one dictionary for the whole city, so a fixed mix of the code is a stable hash
+    station_hashes = (np.arange(len(stations), dtype=np.uint64) + np.uint64(1)) * np.uint64(SKETCH_HASH_MIX)
+    month_idx, weekday_idx = filter_codes(month, day)
+
+    for first in range(0, len(df), chunksize):
+        part = {name: values[first:first + chunksize] for name, values in columns.items()}
+        keep = np.ones(len(part['month']), dtype=bool)
+        if month_idx is not None:
+            keep &= part['month'] == month_idx
+        if weekday_idx is not None:
+            keep &= part['weekday'] == weekday_idx
+        if not keep.any():
+            continue
+        part = {name: values[keep] for name, values in part.items()}
+        for name, station_map in station_maps.items():
+            part[name] = station_map[part[name]]
+        trips = (part['start'] >= 0) & (part['end'] >= 0)
+        durations = part['durations']
+        yield {'rows': int(keep.sum()), 'month': part['month'], 'weekday': part['weekday'], 'hour': part['hour'],
+               'start': part['start'][trips], 'end': part['end'][trips],
+               'stations': stations, 'station_hashes': station_hashes,
+               'durations': durations[~np.isnan(durations)],
+               'user_types': pd.Series(count_codes(part['user_types'], len(user_labels)), index=user_labels),
+               'genders': pd.Series(count_codes(part['genders'], len(gender_labels)), index=gender_labels)
+               if has_genders else None,
+               'birth_years': part['birth_years'][~np.isnan(part['birth_years'])] if has_genders else None}
+
+def approx_stats(city, month, day, chunksize=None):
+    """Estimates the statistics of a query in one pass over bounded chunks with fixed memory.
+
+    Popular stations and routes come from Count-Min sketches with a small set of
+    heavy-hitter candidates, so memory does not grow with the number of rows or of
+    distinct stations. Times, user types and genders are small domains and are counted
+    exactly; birth years use a fixed histogram of the years BIRTH_YEAR_RANGE covers, and
+    durations a running sum plus a fixed log-binned histogram. The rows come from
+    approx_chunks, so the column store is used whenever it is current.
+
+    Args:
+        (str) city - name of the city to analyze
+        (str) month - name of the month to filter by, or "all" to apply no month filter
+        (str) day - name of the day of week to filter by, or "all" to apply no day filter
+        (int) chunksize - rows handled at a time, or None for SCAN_CHUNKSIZE
+
     Returns:
-        str: Validated user input.
+        (dict) the keys of compute_stats, with estimated station and route counts, plus
+            'error_bounds' (overcount bounds and their confidence, and how many birth
+            years fell outside the histogram) and 'duration_histogram'
     """
-    valid_inputs = {
-        'city': ['chicago', 'new york city', 'washington'],
-        'month': ['january', 'february', 'march', 'april', 'may', 'june', 'all'],
-        'day': ['sunday', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'all']
-    }
+    sketches = {'start': new_sketch(), 'end': new_sketch(), 'route': new_sketch()}
+    first_year, last_year = BIRTH_YEAR_RANGE
+    years = np.zeros(last_year - first_year + 1, dtype=np.int64)
+    duration_edges = np.logspace(*DURATION_BIN_LOGSPACE)
+    durations = np.zeros(len(duration_edges) + 1, dtype=np.int64)
+    totals = {'rows': 0, 'month': np.zeros(13, dtype=np.int64), 'weekday': np.zeros(7, dtype=np.int64),
+              'hour': np.zeros(24, dtype=np.int64), 'duration_sum': 0.0, 'duration_count': 0,
+              'years_clipped': 0}
+    user_types, genders = pd.Series(dtype=np.int64), None
 
-    while True:
-<<<<<<< HEAD
-<<<<<<< HEAD
-        line_input = input(str_inp)
-        try:
-            # Check if input matches expected city names
-            if line_input in ['chicago', 'new york city', 'washington'] and runtype == 1:
-                break
-            elif line_input in ['january', 'february', 'march', 'april', 'may', 'june','all'] and runtype == 2:
-            # Check if input matches expected month names
-            elif line_input in ['january', 'february', 'march', 'april', 'may', 'june', 'all'] and runtype == 2:
-                break
-            # Check if input matches expected day names
-            elif line_input in ['sunday', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'all'] and runtype == 3:
-                break
-            else:
-                # Provide feedback for invalid city input
-                if runtype == 1:
-                    print("please enter: chicago, new york city or washington")
-                # Provide feedback for invalid month input
-                if runtype == 2:
-                    print("please enter: january-june or all")
-                # Provide feedback for invalid day input
-                if runtype == 3:
-                    print("please enter: sunday-saturday or all")
-        except ValueError:
-            print("wrong input!")
-    return line_input
-||||||| parent of e9167d5 (Your descriptive commit message here)
-        line_input = input(str_inp)
-        try:
-            # Check if input matches expected city names
-            if line_input in ['chicago', 'new york city', 'washington'] and runtype == 1:
-                break
-            # Check if input matches expected month names
-            elif line_input in ['january', 'february', 'march', 'april', 'may', 'june', 'all'] and runtype == 2:
-                break
-            # Check if input matches expected day names
-            elif line_input in ['sunday', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'all'] and runtype == 3:
-                break
-            else:
-                # Provide feedback for invalid city input
-                if runtype == 1:
-                    print("please enter: chicago, new york city or washington")
-                # Provide feedback for invalid month input
-                if runtype == 2:
-                    print("please enter: january-june or all")
-                # Provide feedback for invalid day input
-                if runtype == 3:
-                    print("please enter: sunday-saturday or all")
-        except ValueError:
-            print("wrong input!")
-    return line_input
-=======
-        line_input = input(prompt)
-        if line_input in valid_inputs[input_type]:
-            return line_input
-        print(f"Invalid input! Please enter one of the following: {', '.join(valid_inputs[input_type])}")
->>>>>>> e9167d5 (Your descriptive commit message here)
-||||||| parent of 8ca043b (two changes)
-        line_input = input(str_inp)
-        try:
-            # Check if input matches expected city names
-            if line_input in ['chicago', 'new york city', 'washington'] and runtype == 1:
-                break
-            # Check if input matches expected month names
-            elif line_input in ['january', 'february', 'march', 'april', 'may', 'june', 'all'] and runtype == 2:
-                break
-            # Check if input matches expected day names
-            elif line_input in ['sunday', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'all'] and runtype == 3:
-                break
-            else:
-                # Provide feedback for invalid city input
-                if runtype == 1:
-                    print("please enter: chicago, new york city or washington")
-                # Provide feedback for invalid month input
-                if runtype == 2:
-                    print("please enter: january-june or all")
-                # Provide feedback for invalid day input
-                if runtype == 3:
-                    print("please enter: sunday-saturday or all")
-        except ValueError:
-            print("wrong input!")
-    return line_input
-=======
-        line_input = input(prompt).lower()
-        if line_input in valid_inputs:
-            return line_input
+    with span('approx_stats', city=city, month=month, day=day) as record:
+        for part in approx_chunks(city, month, day, chunksize):
+            totals['rows'] += part['rows']
+            totals['month'] += count_codes(part['month'], 13)
+            totals['weekday'] += count_codes(part['weekday'], 7)
+            totals['hour'] += count_codes(part['hour'], 24)
+
+            stations, start, end = part['stations'], part['start'], part['end']
+            start_hashes = part['station_hashes'][start]
+            end_hashes = part['station_hashes'][end]
+            sketch_update(sketches['start'], start_hashes, lambda index: stations[start[index]])
+            sketch_update(sketches['end'], end_hashes, lambda index: stations[end[index]])
+            route_hashes = start_hashes * np.uint64(SKETCH_HASH_MIX) ^ end_hashes
+            sketch_update(sketches['route'], route_hashes,
+                          lambda index: (stations[start[index]], stations[end[index]]))
+
+            totals['duration_sum'] += part['durations'].sum()
+            totals['duration_count'] += len(part['durations'])
+            durations += np.bincount(np.searchsorted(duration_edges, part['durations']), minlength=len(durations))
+
+            user_types = user_types.add(part['user_types'], fill_value=0)
+            if part['genders'] is not None:
+                genders = part['genders'] if genders is None else genders.add(part['genders'], fill_value=0)
+                # Years outside BIRTH_YEAR_RANGE are counted in the nearest end bin
+                birth_years = part['birth_years'].astype(np.int64) - first_year
+                outside = (birth_years < 0) | (birth_years >= len(years))
+                totals['years_clipped'] += int(outside.sum())
+                years += np.bincount(birth_years.clip(0, len(years) - 1), minlength=len(years))
+        record['rows_in'] = totals['rows']
+
+    stats = {'rows': totals['rows'],
+             'popular_month': mode_label(totals['month'], np.arange(13)),
+             'popular_day': mode_label(totals['weekday'], np.array(DAY_NAMES)),
+             'popular_hour': mode_label(totals['hour'], np.arange(24))}
+    top_start = sketch_top(sketches['start'], 1)
+    top_end = sketch_top(sketches['end'], 1)
+    stats['popular_start_station'] = top_start[0][0] if top_start else None
+    stats['popular_end_station'] = top_end[0][0] if top_end else None
+    stats['top_routes'] = [(route[0], route[1], count) for route, count in
+                           sketch_top(sketches['route'], max(TOP_ROUTES, 1))]
+    stats['popular_trip'] = stats['top_routes'][0] if stats['top_routes'] else None
+
+    stats['total_duration'] = totals['duration_sum']
+    stats['mean_duration'] = totals['duration_sum'] / totals['duration_count'] if totals['duration_count'] else np.nan
+    stats['duration_histogram'] = {'edges': duration_edges, 'counts': durations}
+
+    stats['user_types'] = value_counts_from(user_types.to_numpy(dtype=np.int64), np.asarray(user_types.index),
+                                            'User Type')
+    station_error, confidence = sketch_error(sketches['start'])
+    stats['error_bounds'] = {'station_count': station_error,
+                             'route_count': sketch_error(sketches['route'])[0],
+                             'confidence': confidence}
+    if genders is not None:
+        stats['genders'] = value_counts_from(genders.to_numpy(dtype=np.int64), np.asarray(genders.index), 'Gender')
+        seen_years = np.flatnonzero(years)
+        if len(seen_years):
+            stats['common_birth_year'] = float(first_year + np.argmax(years))
+            stats['recent_birth_year'] = float(first_year + seen_years[-1])
+            stats['earliest_birth_year'] = float(first_year + seen_years[0])
         else:
-            print(f"Please enter one of the following: {', '.join(valid_inputs)}")
->>>>>>> 8ca043b (two changes)
+            stats['common_birth_year'] = stats['recent_birth_year'] = stats['earliest_birth_year'] = None
+        # Exact whenever no year was clipped; otherwise the earliest and most recent years
+        # may lie further out than reported, and the most common year may be an end bin
+        stats['error_bounds']['birth_years_clipped'] = totals['years_clipped']
+        stats['error_bounds']['birth_year_range'] = BIRTH_YEAR_RANGE
+    return stats
 
-def get_filters():
-<<<<<<< HEAD
-    """Prompts user for city, month, and day to analyze."""
-    """
-    Asks the user to specify a city, month, and day to analyze.
-||||||| parent of 8ca043b (two changes)
+def sorted_percentiles(values, starts, counts, percentiles):
+    """Returns the percentiles of groups laid out one after another in a sorted array.
+
+    Uses the same linear interpolation as np.percentile, for every group at once.
+
+    Args:
+        values - the values of every group, each group's slice sorted ascending
+        starts - where each group's slice begins
+        counts - how many values each group has
+        percentiles - the percentiles to compute, between 0 and 100
+
+    Returns:
+        (array) a (groups, percentiles) float array, NaN for empty groups
     """
-    Asks the user to specify a city, month, and day to analyze.
-=======
-    """Asks the user to specify a city, month, and day to analyze.
->>>>>>> 8ca043b (two changes)
-    
+    positions = (counts[:, None] - 1) * (np.asarray(percentiles, dtype=np.float64)[None, :] / 100)
+    positions = np.maximum(positions, 0)
+    lower = np.floor(positions).astype(np.int64)
+    upper = np.ceil(positions).astype(np.int64)
+    if len(values) == 0:
+        return np.full(positions.shape, np.nan)
+    last = len(values) - 1
+    low_values = values[np.minimum(starts[:, None] + lower, last)]
+    high_values = values[np.minimum(starts[:, None] + upper, last)]
+    result = low_values + (high_values - low_values) * (positions - lower)
+    result[counts == 0] = np.nan
+    return result
+
+def duration_analytics(df, percentiles=None):
+    """Computes trip duration percentiles and log-binned histograms, overall and per group.
+
+    The durations are sorted once. Each grouping (start hour, user type) is then laid out
+    with a stable sort on its small integer codes, which keeps the durations sorted inside
+    every group, so all percentiles are read off by index and all histograms come from a
+    single np.bincount.
+
+    Args:
+        df - Pandas DataFrame containing city data filtered by month and day
+        percentiles - percentiles to compute, or None for DURATION_PERCENTILES
+
     Returns:
-        (str) city - name of the city to analyze
-        (str) month - name of the month to filter by, or "all" to apply no month filter
-        (str) day - name of the day of week to filter by, or "all" to apply no day filter
+        (dict) 'percentiles', 'histogram_edges', 'histogram' and 'count' for all trips, plus
+            'by_hour' and 'by_user_type' dicts holding 'labels', 'count', 'percentiles' and
+            'histogram' arrays with one row per group
     """
-    print('Hello! Let\'s explore some US bikeshare data!')
-<<<<<<< HEAD
-<<<<<<< HEAD
-    # Get user input for city, month, and day using the correct_input function
-    # Get user input for city (chicago, new york city, washington)
-    city = correct_input("Enter a city: ", 1)
-
-    # Get user input for month (all, january, february, ... , june)
-    month = correct_input("Enter a month between January and June: ", 2)
-    day = correct_input("Enter a day between Monday and Saturday: ", 3)
-
-    # Get user input for day of the week (all, monday, tuesday, ... sunday)
-    day = correct_input("Enter a day between monday and saturday: ", 3)
-||||||| parent of e9167d5 (Your descriptive commit message here)
-    # Get user input for city (chicago, new york city, washington)
-    city = correct_input("Enter a city: ", 1)
-
-    # Get user input for month (all, january, february, ... , june)
-    month = correct_input("Enter a month between January and June: ", 2)
-
-    # Get user input for day of the week (all, monday, tuesday, ... sunday)
-    day = correct_input("Enter a day between monday and saturday: ", 3)
-=======
-    city = correct_input("Enter a city: ", 'city')
-    month = correct_input("Enter a month between January and June: ", 'month')
-    day = correct_input("Enter a day between monday and saturday: ", 'day')
->>>>>>> e9167d5 (Your descriptive commit message here)
-||||||| parent of 8ca043b (two changes)
-    # Get user input for city (chicago, new york city, washington)
-    city = correct_input("Enter a city: ", 1)
-
-    # Get user input for month (all, january, february, ... , june)
-    month = correct_input("Enter a month between January and June: ", 2)
-
-    # Get user input for day of the week (all, monday, tuesday, ... sunday)
-    day = correct_input("Enter a day between monday and saturday: ", 3)
-=======
-    
-    city = correct_input("Enter a city (chicago, new york city, washington): ", ['chicago', 'new york city', 'washington'])
-    month = correct_input("Enter a month (january, february, march, april, may, june, or all): ", 
-                          ['january', 'february', 'march', 'april', 'may', 'june', 'all'])
-    day = correct_input("Enter a day (sunday, monday, tuesday, wednesday, thursday, friday, saturday, or all): ", 
-                        ['sunday', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'all'])
->>>>>>> 8ca043b (two changes)
+    percentiles = tuple(percentiles or DURATION_PERCENTILES)
+    with span('duration_analytics', rows_in=len(df)):
+        durations = np.asarray(df['Trip Duration'], dtype=np.float64)
+        known = ~np.isnan(durations)
+        order = np.flatnonzero(known)[np.argsort(durations[known])]
+        sorted_durations = durations[order]
+        edges = np.logspace(*DURATION_BIN_LOGSPACE)
+        bins = np.searchsorted(edges, sorted_durations)
+        bin_count = len(edges) + 1
+
+        result = {'count': len(order), 'histogram_edges': edges,
+                  'percentiles': dict(zip(percentiles, sorted_percentiles(
+                      sorted_durations, np.zeros(1, dtype=np.int64), np.array([len(order)]), percentiles)[0])),
+                  'histogram': np.bincount(bins, minlength=bin_count)}
+
+        user_codes, user_labels = column_codes(df['User Type'])
+        groupings = {'by_hour': (np.asarray(df['hour'], dtype=np.int64), np.arange(24)),
+                     'by_user_type': (np.asarray(user_codes, dtype=np.int64), np.asarray(user_labels))}
+        for name, (codes, labels) in groupings.items():
+            sorted_codes = codes[order]
+            valid = sorted_codes >= 0
+            # A stable sort on the group codes keeps each group's durations in ascending order;
+            # on int16 codes numpy does it as a linear radix sort
+            regroup = np.argsort(sorted_codes[valid].astype(np.int16), kind='stable')
+            group_codes = sorted_codes[valid][regroup]
+            counts = np.bincount(group_codes, minlength=len(labels))
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            result[name] = {'labels': labels, 'count': counts,
+                            'percentiles': sorted_percentiles(sorted_durations[valid][regroup], starts, counts,
+                                                              percentiles),
+                            'histogram': np.bincount(group_codes * bin_count + bins[valid][regroup],
+                                                     minlength=len(labels) * bin_count).reshape(len(labels),
+                                                                                                bin_count)}
+    return result
+
+def print_histogram(counts, edges):
+    """Prints a log-binned duration histogram as bars, skipping empty bins at either end.
+
+    Args:
+        counts - the count of every bin, one more than there are edges
+        edges - the inner bin edges in seconds
+    """
+    edges = np.concatenate([[0], edges, [np.inf]])
+    used = np.flatnonzero(counts)
+    widest = counts.max() if len(used) else 1
+    for position in range(used[0], used[-1] + 1) if len(used) else []:
+        print('  %9.0f - %-9.0f %8d %s' % (edges[position], edges[position + 1], counts[position],
+                                             '#' * int(round(40 * counts[position] / widest))))
+
+def duration_stats(df, analytics=None):
+    """Displays trip duration percentiles, a log-binned histogram and the per hour and per user type breakdowns."""
 
+    print('\nCalculating Trip Duration Percentiles...\n')
+    with span('duration_stats') as record:
+        if analytics is None:
+            analytics = duration_analytics(df)
+        names = ['p%g' % percentile for percentile in analytics['percentiles']]
+
+        # Display the percentiles of all trips
+        print('Trip Duration Percentiles (seconds):')
+        for name, value in zip(names, analytics['percentiles'].values()):
+            print('  %s: %s' % (name, value))
+
+        # Display the histogram
+        print('\nTrip Duration Histogram (seconds):')
+        print_histogram(analytics['histogram'], analytics['histogram_edges'])
+
+        # Display the percentiles per user type and per start hour
+        for title, name in [('User Type', 'by_user_type'), ('Start Hour', 'by_hour')]:
+            group = analytics[name]
+            table = pd.DataFrame(group['percentiles'], index=pd.Index(group['labels'], name=title), columns=names)
+            table.insert(0, 'trips', group['count'])
+            print('\nTrip Duration Percentiles by %s:' % title)
+            print(table[table['trips'] > 0])
+
+    print("\nThis took %s seconds." % (record['duration_ns'] / 1e9))
     print('-'*40)
-    return city, month, day
 
-def load_data(city, month, day):
-<<<<<<< HEAD
-    """Loads data for the specified city and applies filters."""
-    # Load the city's data and convert 'Start Time' to datetime
+def show_stats(city, stats):
+    """Displays precomputed statistics with the four *_stats functions."""
+    time_stats(None, stats)
+    station_stats(None, stats)
+    trip_duration_stats(None, stats)
+    user_stats(None, city, stats)
+
+def cube_path(city):
+    """Returns the path of the precomputed aggregate cube of a city."""
+    return os.path.join(PARTITION_DIR, os.path.splitext(os.path.basename(CITY_DATA[city]))[0] + '.cube')
+
+def cell_aggregates(codes, labels):
+    """Aggregates coded rows per (month, weekday) cell.
+
+    Returns:
+        (dict) the aggregate of each cell that has rows, keyed by (month, weekday)
+    """
+    # Sort the rows by cell once, then aggregate each cell's contiguous slice. Rows without
+    # a start time share cell (0, 7), which only queries without filters include
+    cell_ids = np.where(codes['month'] >= 0, codes['month'] * 8 + codes['weekday'], 7)
+    order = np.argsort(cell_ids, kind='stable')
+    sorted_ids = cell_ids[order]
+    cells = {}
+    for cell_id in np.unique(sorted_ids):
+        rows = order[np.searchsorted(sorted_ids, cell_id):np.searchsorted(sorted_ids, cell_id, side='right')]
+        cell_codes = {column: values[rows] for column, values in codes.items()}
+        cells[divmod(int(cell_id), 8)] = aggregate(cell_codes, labels)
+    return cells
+
+def write_cube(city, cube):
+    """Writes the aggregate cube of a city and keeps it in cube_cache."""
+    os.makedirs(PARTITION_DIR, exist_ok=True)
+    path = cube_path(city)
+    with open(path + '.tmp', 'wb') as cube_file:
+        pickle.dump(cube, cube_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+    cube_cache[city] = cube
+
+def build_cube(city):
+    """Precomputes the aggregate of every (month, weekday) cell of a city.
+
+    Args:
+        (str) city - name of the city
+
+    Returns:
+        (dict) the cube that was written: the source signature, the shared labels
+            and the aggregate of each cell keyed by (month, weekday)
     """
-    Loads data for the specified city and filters by month and day if applicable.
-||||||| parent of 8ca043b (two changes)
+    signature = source_signature(CITY_DATA[city])
+    df = read_city(city)
+    codes, labels = encode_frame(df)
+    cube = {'signature': signature, 'mark': frame_marks[city], 'rows': len(df),
+            'labels': labels, 'cells': cell_aggregates(codes, labels)}
+    write_cube(city, cube)
+    return cube
+
+def labels_cover(labels, new_labels):
+    """Returns True if every label of the new rows already has a code in labels."""
+    for key in ['start', 'end', 'user_types', 'genders']:
+        if new_labels[key] is None:
+            continue
+        if labels[key] is None or not pd.Index(new_labels[key]).isin(labels[key]).all():
+            return False
+    if new_labels['year_span']:
+        first_year, last_year = labels['first_year'], labels['first_year'] + labels['year_span']
+        if new_labels['first_year'] < first_year or new_labels['first_year'] + new_labels['year_span'] > last_year:
+            return False
+    return True
+
+def refresh_city(city):
+    """Brings the cached data, partitions and aggregate cube of a city up to date.
+
+    When rows were only appended to the city file, just those rows are parsed, and they
+    are folded into the cube cells and written as extra partitions. Anything that cannot
+    be updated that way (a rewritten file, or new stations in the cube's case) is rebuilt.
+
+    Args:
+        (str) city - name of the city to refresh
+
+    Returns:
+        (int) the number of rows that were new to the cube
     """
-    Loads data for the specified city and filters by month and day if applicable.
-=======
-    """Loads data for the specified city and filters by month and day if applicable.
->>>>>>> 8ca043b (two changes)
-    
+    filename = CITY_DATA[city]
+    signature = source_signature(filename)
+    with frame_cache_lock:
+        frame_cache.pop(city, None)
+    df = get_city_frame(city)
+
+    manifest = None
+    try:
+        with open(partition_paths(city)[1]) as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        pass
+    if manifest is not None:
+        if appended_since(filename, manifest.get('mark')) and manifest['rows'] <= len(df):
+            with open(partition_paths(city)[0], 'ab') as data_file:
+                data_file.seek(0, os.SEEK_END)
+                manifest['partitions'] += write_partitions(data_file, df.iloc[manifest['rows']:])
+            manifest.update({'signature': list(signature), 'mark': frame_marks[city], 'rows': len(df)})
+            write_manifest(city, manifest)
+        else:
+            ingest_city(city)
+
+    cube = None
+    try:
+        with open(cube_path(city), 'rb') as cube_file:
+            cube = pickle.load(cube_file)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass
+    if cube is None:
+        return 0
+    new_rows = len(df) - cube.get('rows', len(df))
+    if appended_since(filename, cube.get('mark')) and new_rows >= 0:
+        new_df = df.iloc[cube['rows']:]
+        if labels_cover(cube['labels'], encode_frame(new_df)[1]):
+            codes, labels = encode_frame(new_df, cube['labels'])
+            for cell, agg in cell_aggregates(codes, labels).items():
+                cube['cells'][cell] = merge_aggregates([cube['cells'][cell], agg]) if cell in cube['cells'] else agg
+            cube.update({'signature': signature, 'mark': frame_marks[city], 'rows': len(df)})
+            write_cube(city, cube)
+            return new_rows
+    build_cube(city)
+    return len(df)
+
+def read_cube(city):
+    """Returns the aggregate cube of a city, or None if it is missing or out of date."""
+    signature = source_signature(CITY_DATA[city])
+    cube = cube_cache.get(city)
+    if cube is None:
+        try:
+            with open(cube_path(city), 'rb') as cube_file:
+                cube = pickle.load(cube_file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        cube_cache[city] = cube
+    if cube['signature'] != signature:
+        return None
+    return cube
+
+def stats_from_cube(cube, month, day, city=None):
+    """Answers a query by merging the cube cells that match the month and day filters.
+
     Args:
-        (str) city - name of the city to analyze
+        (dict) cube - the city's aggregate cube, as returned by read_cube
         (str) month - name of the month to filter by, or "all" to apply no month filter
         (str) day - name of the day of week to filter by, or "all" to apply no day filter
-    
+        (str) city - name of the city, used to skip gender and birth year for washington
+
     Returns:
-        df - Pandas DataFrame containing city data filtered by month and day
+        (dict) the same statistics as compute_stats on the filtered data
     """
-    df = pd.read_csv(CITY_DATA[city])
-<<<<<<< HEAD
-||||||| parent of 8ca043b (two changes)
-
-    # Convert the 'Start Time' column to datetime
-=======
-
-    # Convert the 'Start Time' column to datetime and extract month, day of week, and hour
->>>>>>> 8ca043b (two changes)
-    df['Start Time'] = pd.to_datetime(df['Start Time'])
-<<<<<<< HEAD
-<<<<<<< HEAD
-    
-    # Extract month, day of week, hour from Start Time to create new columns
-
-    # Extract month, day of week, and hour from 'Start Time' to create new columns
-||||||| parent of e9167d5 (Your descriptive commit message here)
-||||||| parent of 8ca043b (two changes)
-
-    # Extract month, day of week, and hour from 'Start Time' to create new columns
-    df['month'] = df['Start Time'].dt.month
-    df['day_of_week'] = df['Start Time'].dt.weekday_name
-    df['hour'] = df['Start Time'].dt.hour
-=======
-    df['month'] = df['Start Time'].dt.month
-    df['day_of_week'] = df['Start Time'].dt.day_name()
-    df['hour'] = df['Start Time'].dt.hour
->>>>>>> 8ca043b (two changes)
-
-<<<<<<< HEAD
-    # Extract month, day of week, and hour from 'Start Time' to create new columns
-=======
->>>>>>> e9167d5 (Your descriptive commit message here)
-    df['month'] = df['Start Time'].dt.month
-    df['day_of_week'] = df['Start Time'].dt.day_name()
-
-    # Filter by month and day
-||||||| parent of 8ca043b (two changes)
-    # Filter by month if applicable
-=======
-    # Filter the DataFrame based on month and day
->>>>>>> 8ca043b (two changes)
-    if month != 'all':
-<<<<<<< HEAD
-<<<<<<< HEAD
-        # Use the index of the months list to get the corresponding int
-        # Get the corresponding int for the month
-        months = ['january', 'february', 'march', 'april', 'may', 'june']
-        month = months.index(month) + 1
-        
-        # Filter by month to create the new DataFrame
-||||||| parent of e9167d5 (Your descriptive commit message here)
-        # Get the corresponding int for the month
-        months = ['january', 'february', 'march', 'april', 'may', 'june']
-        month = months.index(month) + 1
-=======
-        month_idx = ['january', 'february', 'march', 'april', 'may', 'june'].index(month) + 1
-        df = df[df['month'] == month_idx]
->>>>>>> e9167d5 (Your descriptive commit message here)
-||||||| parent of 8ca043b (two changes)
-        # Get the corresponding int for the month
-        months = ['january', 'february', 'march', 'april', 'may', 'june']
-        month = months.index(month) + 1
-=======
-        month_idx = ['january', 'february', 'march', 'april', 'may', 'june'].index(month) + 1
-        df = df[df['month'] == month_idx]
->>>>>>> 8ca043b (two changes)
-
-    if day != 'all':
-<<<<<<< HEAD
-<<<<<<< HEAD
-        # Filter by day of week to create the new DataFrame
-        # Filter by day of week to create a new DataFrame
-||||||| parent of e9167d5 (Your descriptive commit message here)
-        # Filter by day of week to create a new DataFrame
-=======
->>>>>>> e9167d5 (Your descriptive commit message here)
-||||||| parent of 8ca043b (two changes)
-        # Filter by day of week to create a new DataFrame
-=======
->>>>>>> 8ca043b (two changes)
-        df = df[df['day_of_week'] == day.title()]
+    month_idx, weekday_idx = filter_codes(month, day)
 
-    return df
+    aggs = [agg for (cell_month, cell_weekday), agg in cube['cells'].items()
+            if (month_idx is None or cell_month == month_idx)
+            and (weekday_idx is None or cell_weekday == weekday_idx)]
+    if not aggs:
+        aggs = [empty_aggregate(cube['labels'])]
+    with span('stats_from_cube', city=city, month=month, day=day, cells=len(aggs)):
+        return finish_stats(merge_aggregates(aggs), cube['labels'], city)
 
-<<<<<<< HEAD
-def time_stats(df):
-    """Displays statistics on the most frequent times of travel."""
-    
-    print('\nCalculating The Most Frequent Times of Travel...\n')
-    start_time = time.time()
+def get_stats(city, month, day, df=None):
+    """Returns the statistics for a query, from the aggregate cube when one is up to date.
 
-    # Calculate and print the most common month, day, and start hour
-    # Display the most common month
-    popular_month = df['month'].mode()[0]
-    print('Most Popular Month:', popular_month)
+    The filtered data is only loaded (when df is not given) if there is no usable cube.
+    """
+    cube = read_cube(city)
+    if cube is not None:
+        return stats_from_cube(cube, month, day, city)
+    if df is None:
+        df = load_data(city, month, day)
+    return compute_stats(df, city)
 
-    # Display the most common day of the week
-    most_common_day = df['day_of_week'].mode()[0]
-    print('Most Day Of Week:', most_common_day)
+def od_path(city):
+    """Returns the path of the origin-destination matrix of a city."""
+    return os.path.join(PARTITION_DIR, os.path.splitext(os.path.basename(CITY_DATA[city]))[0] + '.od.npz')
 
-    # Display the most common start hour
-    most_common_start_hour = df['hour'].mode()[0]
-    print('Most Common Start Hour:', most_common_start_hour)
+def od_slice_id(month, day):
+    """Returns the slice of a query in an OD matrix: month 1-12 or 0 for all, weekday 0-6 or 7 for all."""
+    month_idx, weekday_idx = filter_codes(month, day)
+    return (month_idx or 0) * 8 + (7 if weekday_idx is None else weekday_idx)
 
-    print("\nThis took %s seconds." % (time.time() - start_time))
-    print('-'*40)
+def build_od(city):
+    """Builds and writes the origin-destination matrix of a city.
 
-def station_stats(df):
-    """Displays statistics on the most popular stations and trip."""
-    """Displays statistics on the most popular stations and trips."""
-    
-    print('\nCalculating The Most Popular Stations and Trip...\n')
-    start_time = time.time()
+    The matrix is stored sparse, in coordinate form sorted by slice, so every month and
+    weekday slice (including the "all" ones) is one contiguous run of int32 start codes,
+    end codes and trip counts, ordered by trip count. Station codes index station_labels,
+    the city's station dictionary. All slices come from one np.unique over packed (slice,
+    start, end) keys.
 
-    # Display most commonly used start station
-    popular_start_station = df['Start Station'].mode()[0]
-    print('Most Start Station:', popular_start_station)
+    Args:
+        (str) city - name of the city
 
-    # Display most commonly used end station
-    popular_end_station = df['End Station'].mode()[0]
-    print('Most End Station:', popular_end_station)
+    Returns:
+        (dict) the matrix that was written: 'signature', 'stations', 'slice_ptr' (where
+            each slice begins in the entry arrays) and the 'starts', 'ends' and 'counts' arrays
+    """
+    with span('build_od', city=city) as record:
+        signature = source_signature(CITY_DATA[city])
+        df = get_city_frame(city)
+        # Both columns are coded against every station either of them names
+        labels = station_labels(df)
+        stations = np.asarray(labels, dtype=str)
+        size = len(stations)
+        start_codes = recode_map(df['Start Station'].cat.categories, labels)[df['Start Station'].cat.codes]
+        end_codes = recode_map(df['End Station'].cat.categories, labels)[df['End Station'].cat.codes]
+        valid = (start_codes >= 0) & (end_codes >= 0)
+        months = np.asarray(df['month'], dtype=np.int64)[valid]
+        weekdays = np.asarray(df['day_of_week'].cat.codes, dtype=np.int64)[valid]
+        pairs = start_codes[valid].astype(np.int64) * size + end_codes[valid]
+        record['rows_in'] = len(df)
 
-    # Display most frequent combination of start station and end station trip
-    frequent_combination = df.groupby(['Start Station', 'End Station'])
-    popular_frequent_combo_station = frequent_combination.size().sort_values(ascending=False).head(1)
-    print('Most frequent combination of Start Station and End Station trip:\n', popular_frequent_combo_station)
+        # Count each (month, weekday) cell first, then fold those counts into the
+        # per-month, per-weekday and overall slices, which is far fewer entries than rows.
+        # Trips without a start time only count towards the overall slice
+        known = months >= 0
+        cell_keys, cell_counts = np.unique(((months * 8 + weekdays) * size * size + pairs)[known],
+                                           return_counts=True)
+        cells, cell_pairs = np.divmod(cell_keys, size * size)
+        cell_months, cell_weekdays = np.divmod(cells, 8)
+        slices = np.concatenate([cells, cell_months * 8 + 7, cell_weekdays, np.full(len(cells), 7)])
+        keys, inverse = np.unique(np.concatenate([slices * size * size + np.tile(cell_pairs, 4),
+                                                  7 * size * size + pairs[~known]]), return_inverse=True)
+        counts = np.bincount(inverse, weights=np.concatenate([np.tile(cell_counts, 4),
+                                                              np.ones(np.count_nonzero(~known))]))
+        counts = counts.astype(np.int32)
+        slice_ids, pair_keys = np.divmod(keys, size * size)
+        # Within a slice, most trips first (lowest pair on ties), so top routes are a prefix
+        order = np.lexsort((pair_keys, -counts, slice_ids))
+        slice_ids, pair_keys, counts = slice_ids[order], pair_keys[order], counts[order]
+        starts, ends = np.divmod(pair_keys, size)
 
-    print("\nThis took %s seconds." % (time.time() - start_time))
-    print('-'*40)
+        od = {'signature': np.asarray(signature, dtype=np.int64), 'stations': stations,
+              'slice_ptr': np.searchsorted(slice_ids, np.arange(13 * 8 + 1)),
+              'starts': starts.astype(np.int32), 'ends': ends.astype(np.int32), 'counts': counts}
+        record['rows_out'] = len(counts)
 
-def trip_duration_stats(df):
-    """Displays statistics on the total and average trip duration."""
-    
-    print('\nCalculating Trip Duration...\n')
-    start_time = time.time()
+        os.makedirs(PARTITION_DIR, exist_ok=True)
+        path = od_path(city)
+        with open(path + '.tmp', 'wb') as od_file:
+            np.savez(od_file, **od)
+        os.replace(path + '.tmp', path)
+        od_cache[city] = od
+    return od
 
-    # Display total travel time
-    total_travel_time = df['Trip Duration'].sum()
-    print('Total Travel Time:', total_travel_time)
+def read_od(city):
+    """Returns the origin-destination matrix of a city, building it if it is missing or out of date."""
+    signature = np.asarray(source_signature(CITY_DATA[city]), dtype=np.int64)
+    od = od_cache.get(city)
+    if od is None:
+        try:
+            with np.load(od_path(city)) as od_file:
+                od = {name: od_file[name] for name in od_file.files}
+        except (OSError, ValueError, KeyError):
+            od = None
+    if od is None or not np.array_equal(od['signature'], signature):
+        return build_od(city)
+    od_cache[city] = od
+    return od
 
-    # Display mean travel time
-    mean_travel_time = df['Trip Duration'].mean()
-    print('Mean Travel Time:', mean_travel_time)
+def od_entries(od, month, day):
+    """Returns the (starts, ends, counts) arrays of the stations pairs in a query's slice."""
+    slice_id = od_slice_id(month, day)
+    first, last = od['slice_ptr'][slice_id], od['slice_ptr'][slice_id + 1]
+    return od['starts'][first:last], od['ends'][first:last], od['counts'][first:last]
 
-    print("\nThis took %s seconds." % (time.time() - start_time))
-    print('-'*40)
+def od_top_routes(od, month, day, n=10):
+    """Returns the n most frequent routes of a slice as a list of ((start, end), trips), most trips first."""
+    starts, ends, counts = od_entries(od, month, day)
+    return [((str(od['stations'][start]), str(od['stations'][end])), int(trips))
+            for start, end, trips in zip(starts[:n], ends[:n], counts[:n])]
 
-def user_stats(df, city):
-    """Displays statistics on bikeshare users."""
-    
-    print('\nCalculating User Stats...\n')
-    start_time = time.time()
-
-    # Show user type counts and, if applicable, gender and birth year stats
-    print('User Type Stats:')
-    print(df['User Type'].value_counts())
-    
-    if city != 'washington':
-        print('Gender Stats:')
-        print(df['Gender'].value_counts())
-        
-        # Display earliest, most recent, and most common year of birth
-        print('Birth Year Stats:')
-        most_common_year = df['Birth Year'].mode()[0]
-        print('Most Common Year:', most_common_year)
-        most_recent_year = df['Birth Year'].max()
-        print('Most Recent Year:', most_recent_year)
-        earliest_year = df['Birth Year'].min()
-        print('Earliest Year:', earliest_year)
-
-        print('Earliest Year:', earliest_year)
-    
-    print("\nThis took %s seconds." % (time.time() - start_time))
-    print('-'*40)
+def od_flows(od, month, day):
+    """Returns the outflow, inflow and net imbalance (inflow - outflow) of every station in a slice.
 
-def data_info(df):
-<<<<<<< HEAD
-    """Displays five rows of bikeshare data."""
-    """Displays five rows of bikeshare data if the user wishes to see it."""
-    
-||||||| parent of e9167d5 (Your descriptive commit message here)
-    """Displays five rows of bikeshare data if the user wishes to see it."""
-    
-=======
-    """Displays five rows of bikeshare data if the user wishes to see it.""" 
->>>>>>> e9167d5 (Your descriptive commit message here)
-    response_locket = ['yes', 'no']
-    read_data = ''
-    counter = 0
-    
-    while read_data not in response_locket:
-        print('\nDo you wish to view the raw bikeshare data?')
-        print('\nRight responses: \nyes or no')
-        print('\nValid responses: \nyes or no')
-        read_data = input().lower()
-        if read_data == 'yes':
-           print(df.head())
-        elif read_data not in response_locket:
-            print('Wrong input!')
-            print('Reloading...\n')
-            print('Wrong input!')
-            print('Reloading...\n')
-    
-    while read_data == 'yes':
-        print('Wish to view more data?')
-        counter += 5
-        print('Do you wish to view more data?')
-        counter += 5
-        read_data = input().lower()
-        if read_data == 'yes':
-              print(df[counter:counter + 5])
-        elif read_data != 'yes':
-              break
+    Returns:
+        (tuple) three int64 arrays indexed by station code
+    """
+    starts, ends, counts = od_entries(od, month, day)
+    size = len(od['stations'])
+    outflow = np.bincount(starts, weights=counts, minlength=size).astype(np.int64)
+    inflow = np.bincount(ends, weights=counts, minlength=size).astype(np.int64)
+    return outflow, inflow, inflow - outflow
+
+def od_stats(city, month, day, n=10):
+    """Displays the top routes, the busiest stations and the most unbalanced stations of a slice."""
+
+    print('\nCalculating Origin-Destination Flows...\n')
+    with span('od_stats', city=city, month=month, day=day) as record:
+        od = read_od(city)
 
-print('_'*40)
+        # Display the most frequent routes
+        print('Top %d Routes:' % n)
+        for (start, end), trips in od_top_routes(od, month, day, n):
+            print('  %s -> %s: %d' % (start, end, trips))
 
-print('_' * 40)
-||||||| parent of 8ca043b (two changes)
-def time_stats(df):
+        # Display the busiest stations and the ones that gain or lose the most bikes
+        outflow, inflow, net = od_flows(od, month, day)
+        flows = pd.DataFrame({'outflow': outflow, 'inflow': inflow, 'net': net},
+                             index=pd.Index(od['stations'], name='Station'))
+        print('\nBusiest Stations (trips starting plus ending):')
+        print(flows.loc[flows.index[top_pairs(np.arange(len(flows)), outflow + inflow, n)]])
+        print('\nMost Unbalanced Stations (net = arrivals - departures):')
+        print(flows.loc[flows.index[top_pairs(np.arange(len(flows)), np.abs(net), n)]])
+
+    print("\nThis took %s seconds." % (record['duration_ns'] / 1e9))
+    print('-'*40)
+
+def time_stats(df, stats=None):
     """Displays statistics on the most frequent times of travel."""
-    
+
     print('\nCalculating The Most Frequent Times of Travel...\n')
-    start_time = time.time()
+    with span('time_stats') as record:
+        if stats is None:
+            stats = compute_stats(df)
 
-    # Display the most common month
-    popular_month = df['month'].mode()[0]
-    print('Most Popular Month:', popular_month)
+        # Display the most common month
+        print('Most Popular Month:', stats['popular_month'])
 
-    # Display the most common day of the week
-    most_common_day = df['day_of_week'].mode()[0]
-    print('Most Day Of Week:', most_common_day)
+        # Display the most common day of the week
+        print('Most Day Of Week:', stats['popular_day'])
 
-    # Display the most common start hour
-    most_common_start_hour = df['hour'].mode()[0]
-    print('Most Common Start Hour:', most_common_start_hour)
+        # Display the most common start hour
+        print('Most Common Start Hour:', stats['popular_hour'])
 
-    print("\nThis took %s seconds." % (time.time() - start_time))
+    print("\nThis took %s seconds." % (record['duration_ns'] / 1e9))
     print('-'*40)
 
-def station_stats(df):
+def station_stats(df, stats=None):
     """Displays statistics on the most popular stations and trips."""
-    
+
     print('\nCalculating The Most Popular Stations and Trip...\n')
-    start_time = time.time()
+    with span('station_stats') as record:
+        if stats is None:
+            stats = compute_stats(df)
+
+        # Display most commonly used start station
+        print('Most Start Station:', stats['popular_start_station'])
 
-    # Display most commonly used start station
-    popular_start_station = df['Start Station'].mode()[0]
-    print('Most Start Station:', popular_start_station)
+        # Display most commonly used end station
+        print('Most End Station:', stats['popular_end_station'])
 
-    # Display most commonly used end station
-    popular_end_station = df['End Station'].mode()[0]
-    print('Most End Station:', popular_end_station)
+        # Display most frequent combination of start station and end station trip
+        popular_frequent_combo_station = stats['popular_trip']
+        if popular_frequent_combo_station is not None:
+            start_station, end_station, trips = popular_frequent_combo_station
+            index = pd.MultiIndex.from_tuples([(start_station, end_station)], names=['Start Station', 'End Station'])
+            popular_frequent_combo_station = pd.Series([trips], index=index)
+        print('Most frequent combination of Start Station and End Station trip:\n', popular_frequent_combo_station)
 
-    # Display most frequent combination of start station and end station trip
-    frequent_combination = df.groupby(['Start Station', 'End Station'])
-    popular_frequent_combo_station = frequent_combination.size().sort_values(ascending=False).head(1)
-    print('Most frequent combination of Start Station and End Station trip:\n', popular_frequent_combo_station)
+        # Display the top routes report when more than one route is asked for
+        if TOP_ROUTES > 1:
+            print('\nTop %d routes:' % TOP_ROUTES)
+            for rank, (start_station, end_station, trips) in enumerate(stats['top_routes'], start=1):
+                print('%d. %s -> %s (%d trips)' % (rank, start_station, end_station, trips))
 
-    print("\nThis took %s seconds." % (time.time() - start_time))
+        # Approximate results say how far their counts can be off
+        if 'error_bounds' in stats:
+            bounds = stats['error_bounds']
+            print('\nApproximate counts: at most %d too high for stations and %d for routes (%.0f%% confidence).'
+                  % (bounds['station_count'], bounds['route_count'], bounds['confidence'] * 100))
+
+    print("\nThis took %s seconds." % (record['duration_ns'] / 1e9))
     print('-'*40)
 
-def trip_duration_stats(df):
+def trip_duration_stats(df, stats=None):
     """Displays statistics on the total and average trip duration."""
-    
+
     print('\nCalculating Trip Duration...\n')
-    start_time = time.time()
+    with span('trip_duration_stats') as record:
+        if stats is None:
+            stats = compute_stats(df)
 
-    # Display total travel time
-    total_travel_time = df['Trip Duration'].sum()
-    print('Total Travel Time:', total_travel_time)
+        # Display total travel time
+        print('Total Travel Time:', stats['total_duration'])
 
-    # Display mean travel time
-    mean_travel_time = df['Trip Duration'].mean()
-    print('Mean Travel Time:', mean_travel_time)
+        # Display mean travel time
+        print('Mean Travel Time:', stats['mean_duration'])
 
-    print("\nThis took %s seconds." % (time.time() - start_time))
+        if 'duration_histogram' in stats:
+            # Display the histogram kept by approx_stats
+            print('\nTrip Duration Histogram (seconds):')
+            print_histogram(stats['duration_histogram']['counts'], stats['duration_histogram']['edges'])
+
+    print("\nThis took %s seconds." % (record['duration_ns'] / 1e9))
     print('-'*40)
 
-def user_stats(df, city):
+def user_stats(df, city, stats=None):
     """Displays statistics on bikeshare users."""
-    
+
     print('\nCalculating User Stats...\n')
-    start_time = time.time()
-
-    # Display counts of user types
-    print('User Type Stats:')
-    print(df['User Type'].value_counts())
-    
-    if city != 'washington':
-        # Display counts of gender
-        print('Gender Stats:')
-        print(df['Gender'].value_counts())
-        
-        # Display earliest, most recent, and most common year of birth
-        print('Birth Year Stats:')
-        most_common_year = df['Birth Year'].mode()[0]
-        print('Most Common Year:', most_common_year)
-        most_recent_year = df['Birth Year'].max()
-        print('Most Recent Year:', most_recent_year)
-        earliest_year = df['Birth Year'].min()
-        print('Earliest Year:', earliest_year)
-    
-    print("\nThis took %s seconds." % (time.time() - start_time))
+    with span('user_stats') as record:
+        if stats is None:
+            stats = compute_stats(df, city)
+
+        # Display counts of user types
+        print('User Type Stats:')
+        print(stats['user_types'])
+
+        if 'genders' in stats:
+            # Display counts of gender
+            print('Gender Stats:')
+            print(stats['genders'])
+
+            # Display earliest, most recent, and most common year of birth
+            print('Birth Year Stats:')
+            print('Most Common Year:', stats['common_birth_year'])
+            print('Most Recent Year:', stats['recent_birth_year'])
+            print('Earliest Year:', stats['earliest_birth_year'])
+
+            bounds = stats.get('error_bounds', {})
+            if bounds.get('birth_years_clipped'):
+                print('\nApproximate birth years: %d outside %d-%d were counted as the nearest of those years.'
+                      % ((bounds['birth_years_clipped'],) + tuple(bounds['birth_year_range'])))
+
+    print("\nThis took %s seconds." % (record['duration_ns'] / 1e9))
     print('-'*40)
 
-def data_info(df):
-    """Displays five rows of bikeshare data if the user wishes to see it."""
-    
+def build_row_index(city):
+    """Builds the row-offset index of a city file: where each row starts, plus its month and weekday.
+
+    Line starts are found by scanning the raw bytes for newlines with numpy, and the
+    month/weekday codes come from reading only the 'Start Time' column. Rows are assumed
+    not to contain quoted line breaks; if the counts disagree, None is returned.
+
+    Returns:
+        (dict) 'starts' (int64 byte offsets, one more than the rows), 'month' and 'weekday' (int8)
+    """
+    filename = CITY_DATA[city]
+    size = os.path.getsize(filename)
+    newlines = []
+    with open(filename, 'rb') as city_file:
+        position = 0
+        while True:
+            block = city_file.read(1 << 26)
+            if not block:
+                break
+            newlines.append(np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord('\n')) + position)
+            position += len(block)
+    line_starts = np.concatenate([[0]] + [found + 1 for found in newlines]).astype(np.int64)
+    if line_starts[-1] != size:
+        line_starts = np.append(line_starts, size)
+    # Skip the header line; the last entry is where the final row ends
+    starts = line_starts[1:]
+
+    months, weekdays = [], []
+    for chunk in pd.read_csv(filename, usecols=['Start Time'], chunksize=SCAN_CHUNKSIZE):
+        add_time_columns(chunk)
+        months.append(chunk['month'].to_numpy())
+        weekdays.append(np.asarray(chunk['day_of_week'].cat.codes, dtype=np.int8))
+    month = np.concatenate(months) if months else np.empty(0, dtype=np.int8)
+    weekday = np.concatenate(weekdays) if weekdays else np.empty(0, dtype=np.int8)
+    if len(month) != len(starts) - 1:
+        return None
+    return {'starts': starts, 'month': month, 'weekday': weekday}
+
+def row_index(city):
+    """Returns the row-offset index of a city, building and storing it in CACHE_DIR when needed.
+
+    Returns:
+        (dict) the index described in build_row_index, or None if the file cannot be indexed
+    """
+    signature = source_signature(CITY_DATA[city])
+    cached = row_index_cache.get(city)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    path = os.path.join(CACHE_DIR, os.path.splitext(os.path.basename(CITY_DATA[city]))[0] + '.rows.npz')
+    index = None
+    try:
+        with np.load(path) as stored:
+            if tuple(stored['signature']) == signature:
+                index = {key: stored[key] for key in ['starts', 'month', 'weekday']}
+    except (OSError, ValueError, KeyError):
+        pass
+
+    if index is None:
+        index = build_row_index(city)
+        if index is not None:
+            try:
+                os.makedirs(CACHE_DIR, exist_ok=True)
+                with open(path + '.tmp', 'wb') as index_file:
+                    np.savez(index_file, signature=np.array(signature, dtype=np.int64), **index)
+                os.replace(path + '.tmp', path)
+            except OSError:
+                pass
+    row_index_cache[city] = (signature, index)
+    return index
+
+def matching_rows(index, month, day):
+    """Returns the row numbers of the index that match the month and day filters."""
+    month_idx, weekday_idx = filter_codes(month, day)
+    mask = np.ones(len(index['month']), dtype=bool)
+    if month_idx is not None:
+        mask &= index['month'] == month_idx
+    if weekday_idx is not None:
+        mask &= index['weekday'] == weekday_idx
+    return np.flatnonzero(mask)
+
+def read_rows(city, index, rows):
+    """Reads the given rows of a city file by seeking straight to their byte offsets.
+
+    Returns:
+        df - Pandas DataFrame of those rows, typed like load_data and indexed by row number
+    """
+    with open(CITY_DATA[city], 'rb') as city_file:
+        lines = [city_file.readline()]
+        for row in rows:
+            city_file.seek(index['starts'][row])
+            lines.append(city_file.read(index['starts'][row + 1] - index['starts'][row]).rstrip(b'\r\n') + b'\n')
+    df = pd.read_csv(io.BytesIO(b''.join(lines)))
+    df.index = pd.Index(rows)
+    return add_time_columns(df)
+
+def data_info(city, month, day):
+    """Displays five rows of bikeshare data at a time if the user wishes to see it.
+
+    Rows are read from the city file on demand through its row-offset index, so nothing is
+    loaded unless the user says yes, and any page can be reached directly by its number.
+    """
+
     response_locket = ['yes', 'no']
     read_data = ''
-    counter = 0
-    
+    page = 0
+
     while read_data not in response_locket:
         print('\nDo you wish to view the raw bikeshare data?')
         print('\nValid responses: \nyes or no')
         read_data = input().lower()
-        if read_data == 'yes':
-           print(df.head())
-        elif read_data not in response_locket:
+        if read_data not in response_locket:
             print('Wrong input!')
             print('Reloading...\n')
-    
-    while read_data == 'yes':
-        print('Do you wish to view more data?')
-        counter += 5
+    if read_data != 'yes':
+        print('_' * 40)
+        return
+
+    index = row_index(city)
+    if index is None:
+        # The file could not be indexed, so page through the loaded data instead
+        df = load_data(city, month, day)
+        rows = np.arange(len(df))
+    else:
+        rows = matching_rows(index, month, day)
+    pages = max((len(rows) + PAGE_SIZE - 1) // PAGE_SIZE, 1)
+
+    while True:
+        page_rows = rows[page * PAGE_SIZE:(page + 1) * PAGE_SIZE]
+        if index is None:
+            print(df.iloc[page_rows])
+        else:
+            print(read_rows(city, index, page_rows))
+        print('Page %d of %d.' % (page + 1, pages))
+        print('Do you wish to view more data? (yes, no, or a page number)')
         read_data = input().lower()
-        if read_data == 'yes':
-              print(df[counter:counter + 5])
-        elif read_data != 'yes':
-              break
+        if read_data == 'yes' and page + 1 < pages:
+            page += 1
+        elif read_data.isdigit() and 1 <= int(read_data) <= pages:
+            page = int(read_data) - 1
+        else:
+            break
+
+    print('_' * 40)
 
-print('_' * 40)
-=======
-# ... (other functions remain unchanged) ...
->>>>>>> 8ca043b (two changes)
+def plain_value(value):
+    """Converts numpy and pandas values in a statistic to plain JSON-friendly Python values."""
+    if isinstance(value, pd.Series):
+        return {str(label): plain_value(count) for label, count in value.items()}
+    if isinstance(value, dict):
+        return {str(key): plain_value(item) for key, item in value.items()}
+    if isinstance(value, np.ndarray):
+        return [plain_value(item) for item in value.tolist()]
+    if isinstance(value, (list, tuple)):
+        return [plain_value(item) for item in value]
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and value != value:
+        return None
+    return value
+
+def stats_record(city, month, day, stats):
+    """Returns the statistics of one query as a flat dict of plain Python values."""
+    record = {'city': city, 'month': month, 'day': day}
+    for key, value in stats.items():
+        record[key] = plain_value(value)
+    return record
+
+def batch_city(city):
+    """Computes the statistics of one city for every month and day filter.
+
+    Runs in a worker process: the city is read and encoded once, and answer_queries answers
+    all 56 combinations from its month and weekday masks.
+
+    Returns:
+        (list) one stats_record per (month, day) combination, in month, day order
+    """
+    return answer_queries([(city, month, day) for month in ['all'] + MONTHS for day in ['all'] + DAYS])
+
+def batch_report(cities=None, workers=None):
+    """Computes the statistics of every (city, month, day) combination on a process pool.
+
+    There is one task per city, so no two workers read the same city.
+
+    Args:
+        (list) cities - names of the cities to report on, or None for every city in CITY_DATA
+        (int) workers - number of worker processes, or None for one per CPU
+
+    Returns:
+        (list) one stats_record per combination, in city, month, day order
+    """
+    with futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(batch_city, cities or list(CITY_DATA))
+        return [record for records in results for record in records]
+
+def write_report(records, output, report_format):
+    """Writes batch records to an open file as JSON or CSV.
+
+    In CSV, nested values (user type and gender counts, top routes) are stored as JSON text.
+    """
+    if report_format == 'json':
+        json.dump(records, output, indent=1)
+        output.write('\n')
+        return
+    fieldnames = list(dict.fromkeys(key for record in records for key in record))
+    writer = csv.DictWriter(output, fieldnames=fieldnames)
+    writer.writeheader()
+    for record in records:
+        writer.writerow({key: json.dumps(value) if isinstance(value, (dict, list)) else value
+                         for key, value in record.items()})
+
+def batch_main(args):
+    """Runs the non-interactive batch report: python bikeshare.py batch [options]."""
+    parser = argparse.ArgumentParser(prog='bikeshare.py batch',
+                                     description='Report statistics for every city, month and day.')
+    parser.add_argument('--city', action='append', type=str.lower, choices=list(CITY_DATA),
+                        help='city to report on (repeatable, default: every city)')
+    parser.add_argument('--format', choices=['json', 'csv'], default='json')
+    parser.add_argument('--output', help='file to write the report to (default: standard output)')
+    parser.add_argument('--workers', type=int, help='number of worker processes (default: one per CPU)')
+    options = parser.parse_args(args)
+
+    records = batch_report(options.city, options.workers)
+    if options.output:
+        with open(options.output, 'w', newline='') as output:
+            write_report(records, output, options.format)
+    else:
+        write_report(records, sys.stdout, options.format)
+
+def read_queries(lines):
+    """Parses a query file: one "city,month,day" line per query, month and day defaulting to "all".
+
+    Blank lines and lines starting with # are skipped.
+
+    Returns:
+        (list) (city, month, day) tuples, in file order
+    """
+    queries = []
+    for number, row in enumerate(csv.reader(lines), 1):
+        if not row or not row[0].strip() or row[0].lstrip().startswith('#'):
+            continue
+        params = {name: [value.strip()] for name, value in zip(['city', 'month', 'day'], row)}
+        try:
+            queries.append(stats_query(params))
+        except ValueError as error:
+            raise ValueError('line %d: %s' % (number, error))
+    return queries
+
+def answer_queries(queries):
+    """Computes the statistics of many queries, loading and encoding each city only once.
+
+    Every month and weekday gets one boolean mask over the city's coded rows; a query
+    combines at most two of them and aggregates the selected codes.
+
+    Args:
+        (list) queries - (city, month, day) tuples
+
+    Returns:
+        (list) one stats_record per query, in the order of the queries
+    """
+    records = [None] * len(queries)
+    for city in dict.fromkeys(query[0] for query in queries):
+        with span('answer_queries', city=city):
+            codes, labels = encode_frame(get_city_frame(city))
+            month_masks = {month_idx: codes['month'] == month_idx for month_idx in range(1, len(MONTHS) + 1)}
+            day_masks = {weekday_idx: codes['weekday'] == weekday_idx for weekday_idx in range(len(DAYS))}
+            for position, (query_city, month, day) in enumerate(queries):
+                if query_city != city:
+                    continue
+                month_idx, weekday_idx = filter_codes(month, day)
+                masks = [mask for mask in [month_masks.get(month_idx), day_masks.get(weekday_idx)] if mask is not None]
+                query_codes = codes
+                if masks:
+                    rows = np.flatnonzero(masks[0] & masks[1] if len(masks) == 2 else masks[0])
+                    query_codes = {key: values[rows] for key, values in codes.items()}
+                stats = finish_stats(aggregate(query_codes, labels), labels, city)
+                records[position] = stats_record(city, month, day, stats)
+    return records
+
+def queries_main(args):
+    """Answers a file of queries without any prompts: python bikeshare.py queries FILE [options]."""
+    parser = argparse.ArgumentParser(prog='bikeshare.py queries',
+                                     description='Report statistics for every query in a file.')
+    parser.add_argument('file', help='file with one "city,month,day" query per line, or - for standard input')
+    parser.add_argument('--format', choices=['json', 'csv'], default='json')
+    parser.add_argument('--output', help='file to write the report to (default: standard output)')
+    options = parser.parse_args(args)
+
+    try:
+        if options.file == '-':
+            queries = read_queries(sys.stdin)
+        else:
+            with open(options.file, newline='') as query_file:
+                queries = read_queries(query_file)
+    except ValueError as error:
+        parser.error(str(error))
+
+    records = answer_queries(queries)
+    if options.output:
+        with open(options.output, 'w', newline='') as output:
+            write_report(records, output, options.format)
+    else:
+        write_report(records, sys.stdout, options.format)
+
+def http_response(writer, status, payload):
+    """Writes a JSON HTTP/1.1 response and marks the connection to be closed."""
+    reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+               500: 'Internal Server Error'}
+    body = json.dumps(payload).encode('utf-8')
+    writer.write(('HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n'
+                  'Connection: close\r\n\r\n' % (status, reasons[status], len(body))).encode('ascii'))
+    writer.write(body)
+
+def stats_query(params):
+    """Validates /stats query parameters and returns (city, month, day), or raises ValueError."""
+    choices = {'city': list(CITY_DATA),
+               'month': MONTHS + ['all'],
+               'day': DAYS + ['all']}
+    query = []
+    for name in ['city', 'month', 'day']:
+        value = params.get(name, ['all' if name != 'city' else ''])[0].lower()
+        if value not in choices[name]:
+            raise ValueError('%s must be one of: %s' % (name, ', '.join(choices[name])))
+        query.append(value)
+    return tuple(query)
+
+async def handle_http(reader, writer, pool):
+    """Answers one HTTP request: GET /stats?city=...&month=...&day=..., /cities or /health."""
+    try:
+        request_line = (await reader.readline()).decode('latin-1').split()
+        # Skip the headers; requests have no body
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        if len(request_line) < 2:
+            http_response(writer, 400, {'error': 'malformed request'})
+        elif request_line[0] != 'GET':
+            http_response(writer, 405, {'error': 'only GET is supported'})
+        else:
+            url = urlsplit(request_line[1])
+            if url.path == '/stats':
+                try:
+                    city, month, day = stats_query(parse_qs(url.query))
+                except ValueError as error:
+                    http_response(writer, 400, {'error': str(error)})
+                else:
+                    # Computations run on the pool so slow queries do not hold up the event loop
+                    stats = await asyncio.get_running_loop().run_in_executor(pool, get_stats, city, month, day)
+                    http_response(writer, 200, stats_record(city, month, day, stats))
+            elif url.path == '/cities':
+                http_response(writer, 200, {'cities': list(CITY_DATA)})
+            elif url.path == '/health':
+                http_response(writer, 200, {'status': 'ok'})
+            else:
+                http_response(writer, 404, {'error': 'unknown path %s' % url.path})
+    except Exception as error:
+        http_response(writer, 500, {'error': repr(error)})
+    finally:
+        await writer.drain()
+        writer.close()
+
+async def serve(host='127.0.0.1', port=8000, workers=None, ready=None):
+    """Runs the statistics HTTP service until it is cancelled.
+
+    Every city in CITY_DATA is loaded (or its aggregate cube read) before the first request
+    is accepted, so queries are answered from memory.
+
+    Args:
+        (str) host - address to listen on; the default only accepts local connections
+        (int) port - TCP port to listen on, or 0 for any free port
+        (int) workers - number of computation threads, or None for the executor default
+        ready - optional callable invoked with the bound (host, port) once the service accepts requests
+    """
+    pool = futures.ThreadPoolExecutor(max_workers=workers)
+    loop = asyncio.get_running_loop()
+    for city in CITY_DATA:
+        if read_cube(city) is None:
+            await loop.run_in_executor(pool, get_city_frame, city)
+
+    server = await asyncio.start_server(lambda reader, writer: handle_http(reader, writer, pool), host, port)
+    try:
+        async with server:
+            if ready is not None:
+                ready(server.sockets[0].getsockname()[:2])
+            await server.serve_forever()
+    finally:
+        pool.shutdown(wait=False)
+
+def serve_main(args):
+    """Runs the HTTP statistics service: python bikeshare.py serve [options]."""
+    parser = argparse.ArgumentParser(prog='bikeshare.py serve', description='Serve bikeshare statistics as JSON.')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, help='number of computation threads')
+    options = parser.parse_args(args)
+    try:
+        asyncio.run(serve(options.host, options.port, options.workers,
+                          lambda address: print('Serving on http://%s:%d' % address)))
+    except KeyboardInterrupt:
+        pass
+
+def answers_path(city):
+    """Returns the path of the file holding a city's already answered command line queries."""
+    return os.path.join(CACHE_DIR, os.path.basename(CITY_DATA[city]) + '.answers.json')
+
+def read_answer(city, month, day):
+    """Returns the stats_record of a query answered before, or None.
+
+    Only the standard library is used, so a repeated query is answered without
+    numpy or pandas ever being imported.
+    """
+    try:
+        with open(answers_path(city)) as answers_file:
+            answers = json.load(answers_file)
+        if answers['signature'] != list(source_signature(CITY_DATA[city])):
+            return None
+        return answers['answers'].get('%s/%s/%d' % (month, day, TOP_ROUTES))
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+def write_answer(city, month, day, record):
+    """Adds a stats_record to a city's answered queries; failures are ignored."""
+    path = answers_path(city)
+    signature = list(source_signature(CITY_DATA[city]))
+    try:
+        with open(path) as answers_file:
+            answers = json.load(answers_file)
+        if answers['signature'] != signature:
+            raise ValueError('answers are for an older version of the city file')
+    except (OSError, ValueError, KeyError, TypeError):
+        answers = {'signature': signature, 'answers': {}}
+    answers['answers']['%s/%s/%d' % (month, day, TOP_ROUTES)] = record
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(path + '.tmp', 'w') as answers_file:
+            json.dump(answers, answers_file)
+        os.replace(path + '.tmp', path)
+    except OSError:
+        pass
+
+def cli_main(args):
+    """Answers one query given on the command line, without any prompts.
+
+    python bikeshare.py --city CITY [--month MONTH] [--day DAY] [--stats GROUP ...] [--format text|json]
+    python bikeshare.py --list-cities
+    """
+    parser = argparse.ArgumentParser(prog='bikeshare.py',
+                                     description='Explore US bikeshare data. Run without arguments for the prompts.')
+    parser.add_argument('--list-cities', action='store_true', help='print the available cities and exit')
+    parser.add_argument('--city', type=str.lower, choices=list(CITY_DATA))
+    parser.add_argument('--month', default='all', type=str.lower, choices=MONTHS + ['all'])
+    parser.add_argument('--day', default='all', type=str.lower, choices=DAYS + ['all'])
+    parser.add_argument('--stats', nargs='+', choices=list(STAT_GROUPS), default=list(STAT_GROUPS),
+                        help='statistics to show (default: all of them)')
+    parser.add_argument('--format', choices=['text', 'json'], default='text')
+    options = parser.parse_args(args)
+
+    if options.list_cities:
+        print('\n'.join(CITY_DATA))
+        return
+    if options.city is None:
+        parser.error('--city is required unless --list-cities is given')
+
+    if options.format == 'json':
+        # Repeated queries come from the answers file, before numpy or pandas are imported
+        record = read_answer(options.city, options.month, options.day)
+        if record is None:
+            stats = get_stats(options.city, options.month, options.day)
+            record = stats_record(options.city, options.month, options.day, stats)
+            write_answer(options.city, options.month, options.day, record)
+        keys = ['city', 'month', 'day', 'rows'] + [key for group in options.stats for key in STAT_GROUPS[group]]
+        print(json.dumps({key: record[key] for key in keys if key in record}, indent=1))
+    else:
+        stats = get_stats(options.city, options.month, options.day)
+        formatters = {'time': lambda: time_stats(None, stats), 'station': lambda: station_stats(None, stats),
+                      'duration': lambda: trip_duration_stats(None, stats),
+                      'user': lambda: user_stats(None, options.city, stats)}
+        for group in options.stats:
+            formatters[group]()
+    export_metrics()
+
+def add_query_arguments(parser):
+    """Adds the CITY [MONTH [DAY]] positional arguments of a one-query subcommand."""
+    parser.add_argument('city', type=str.lower, choices=list(CITY_DATA))
+    parser.add_argument('month', nargs='?', default='all', type=str.lower, choices=MONTHS + ['all'])
+    parser.add_argument('day', nargs='?', default='all', type=str.lower, choices=DAYS + ['all'])
+
+def commands_main(args):
+    """Runs the data maintenance and analysis subcommands: python bikeshare.py COMMAND [arguments]."""
+    parser = argparse.ArgumentParser(prog='bikeshare.py', description='Maintain and analyze bikeshare data.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    city_lists = {}
+    for name, description in [('ingest', 'Partition the city files and build their cubes and OD matrices.'),
+                              ('refresh', 'Pick up rows appended to the city files.')]:
+        command = city_lists[name] = commands.add_parser(name, description=description)
+        command.add_argument('cities', nargs='*', type=str.lower, metavar='city',
+                             help='city to %s (default: every city)' % name)
+    for name, description in [('od', 'Print the top routes and station flows of a query.'),
+                              ('durations', 'Print the trip duration percentiles and histograms of a query.'),
+                              ('stream', 'Compute the statistics of a query in one pass over the city file.'),
+                              ('approx', 'Estimate the statistics of a query with fixed memory.')]:
+        add_query_arguments(commands.add_parser(name, description=description))
+    options = parser.parse_args(args)
+
+    if options.command in ('ingest', 'refresh'):
+        # An empty list cannot be checked against choices, so the cities are checked here
+        for city_name in options.cities:
+            if city_name not in CITY_DATA:
+                city_lists[options.command].error('argument city: invalid choice: %r (choose from %s)'
+                             % (city_name, ', '.join(map(repr, CITY_DATA))))
+        for city_name in options.cities or list(CITY_DATA):
+            if options.command == 'ingest':
+                ingest_city(city_name)
+                build_cube(city_name)
+                build_od(city_name)
+                print('Partitioned', city_name)
+            else:
+                print('Refreshed %s: %d new rows' % (city_name, refresh_city(city_name)))
+    elif options.command == 'od':
+        od_stats(options.city, options.month, options.day)
+    elif options.command == 'durations':
+        duration_stats(load_data(options.city, options.month, options.day))
+    elif options.command == 'stream':
+        show_stats(options.city, stream_stats(options.city, options.month, options.day))
+    else:
+        show_stats(options.city, approx_stats(options.city, options.month, options.day))
 
 def main():
-<<<<<<< HEAD
-    """Main function to run the bikeshare analysis."""
-    """Main function to execute the bikeshare data analysis."""
-    
-||||||| parent of e9167d5 (Your descriptive commit message here)
     """Main function to execute the bikeshare data analysis."""
-    
-=======
-    """Main function to execute the bikeshare data analysis."""  
->>>>>>> e9167d5 (Your descriptive commit message here)
+    first_query = True
     while True:
-        city, month, day = get_filters()  # Get filters from user
-        df = load_data(city, month, day)  # Load and filter data
-        # Call functions to display statistics and data
-        data_info(df)
-        time_stats(df)
-        station_stats(df)
-        trip_duration_stats(df)
-        user_stats(df, city)
         city, month, day = get_filters()  # Get user filters
-        df = load_data(city, month, day)  # Load the filtered data
-        data_info(df)  # Display raw data if requested
-        time_stats(df)  # Display time statistics
-        station_stats(df)  # Display station statistics
-        trip_duration_stats(df)  # Display trip duration statistics
-        user_stats(df, city)  # Display user statistics
+        data_info(city, month, day)  # Display raw data if requested
+        stats = get_stats(city, month, day)  # Compute every statistic in one pass
+        time_stats(None, stats)  # Display time statistics
+        station_stats(None, stats)  # Display station statistics
+        trip_duration_stats(None, stats)  # Display trip duration statistics
+        user_stats(None, city, stats)  # Display user statistics
+
+        export_metrics()  # Write the timing spans of this query, if enabled
+
+        # Speculatively warm the other cities while the first restart prompt waits
+        if first_query:
+            for other_city in CITY_DATA:
+                if other_city != city:
+                    prefetch_city(other_city, speculative=True)
+            first_query = False
 
         # Ask user if they want to restart the analysis
         restart = input('\nWould you like to restart? Enter yes or no.\n')
@@ -582,5 +2563,15 @@ def main():
             break
 
 if __name__ == "__main__":
-    main()
-    main()  # Run the main function
+    if sys.argv[1:2] == ['batch']:
+        batch_main(sys.argv[2:])
+    elif sys.argv[1:2] == ['queries']:
+        queries_main(sys.argv[2:])
+    elif sys.argv[1:2] == ['serve']:
+        serve_main(sys.argv[2:])
+    elif sys.argv[1:2] and sys.argv[1] in ('ingest', 'refresh', 'od', 'durations', 'stream', 'approx'):
+        commands_main(sys.argv[1:])
+    elif sys.argv[1:2] and sys.argv[1].startswith('-'):
+        cli_main(sys.argv[1:])
+    else:
+        main()  # Run the main function
@@ -0,0 +1,289 @@
+import asyncio
+import json
+import threading
+import urllib.error
+import urllib.request
+from collections import OrderedDict
+
+import pandas as pd
+import pytest
+
+import benchmark
+import bikeshare
+
+QUERIES = [('all', 'all'), ('march', 'friday'), ('june', 'all'), ('february', 'sunday')]
+
+
+@pytest.fixture
+def city_dir(tmp_path, monkeypatch):
+    """Runs a test in an empty directory holding one synthetic 'chicago' file, with no cached state."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(bikeshare, 'CITY_DATA', {'chicago': 'chicago.csv'})
+    reset_caches(monkeypatch)
+    benchmark.generate_city_csv('chicago.csv', 20000, stations=50, seed=0)
+    return tmp_path
+
+
+def reset_caches(monkeypatch):
+    """Forgets every frame, cube, index and OD matrix held in memory."""
+    for name, empty in [('frame_cache', OrderedDict()), ('cube_cache', {}), ('frame_marks', {}),
+                        ('row_index_cache', {}), ('od_cache', {}), ('frame_loads', {})]:
+        monkeypatch.setattr(bikeshare, name, empty)
+
+
+def records(stats_of):
+    """Returns the JSON form of every query's statistics, as computed by stats_of(month, day)."""
+    return [json.dumps(bikeshare.stats_record('chicago', month, day, stats_of(month, day)), sort_keys=True)
+            for month, day in QUERIES]
+
+
+def filter_frame(df, month, day):
+    """Filters a parsed city frame by month and day the plain way."""
+    month_idx, weekday_idx = bikeshare.filter_codes(month, day)
+    if month_idx is not None:
+        df = df[df['month'] == month_idx]
+    if weekday_idx is not None:
+        df = df[df['day_of_week'] == bikeshare.DAY_NAMES[weekday_idx]]
+    return df
+
+
+@pytest.mark.parametrize('new_station', [False, True])
+def test_refresh_matches_fresh_parse(city_dir, monkeypatch, new_station):
+    bikeshare.ingest_city('chicago')
+    bikeshare.build_cube('chicago')
+
+    # Append rows from another run. With new_station, most of them start from a station the
+    # cube has never seen, which makes it the most popular start station
+    appended = city_dir / 'appended.csv'
+    benchmark.generate_city_csv(str(appended), 8000, stations=50, seed=1)
+    new_rows = pd.read_csv(appended)
+    if new_station:
+        new_rows.loc[:5999, 'Start Station'] = 'Station New'
+    new_rows.to_csv('chicago.csv', mode='a', header=False, index=False)
+
+    # Known stations are folded into the cube; a new one makes refresh_city rebuild it
+    assert bikeshare.refresh_city('chicago') == (28000 if new_station else 8000)
+    refreshed_cube = records(lambda month, day: bikeshare.get_stats('chicago', month, day))
+    refreshed_partitions = records(lambda month, day: bikeshare.compute_stats(
+        bikeshare.load_data('chicago', month, day), 'chicago'))
+
+    # Parse the whole file again from scratch, with none of the stores written so far
+    monkeypatch.setattr(bikeshare, 'CACHE_DIR', str(city_dir / 'fresh_cache'))
+    monkeypatch.setattr(bikeshare, 'PARTITION_DIR', str(city_dir / 'fresh_partitions'))
+    reset_caches(monkeypatch)
+    df = pd.read_csv('chicago.csv')
+    bikeshare.add_time_columns(df)
+    fresh = records(lambda month, day: bikeshare.compute_stats(filter_frame(df, month, day), 'chicago'))
+
+    assert refreshed_cube == fresh
+    assert refreshed_partitions == fresh
+    assert (json.loads(fresh[0])['popular_start_station'] == 'Station New') == new_station
+
+
+def test_refresh_after_rewrite_rebuilds(city_dir):
+    bikeshare.build_cube('chicago')
+    benchmark.generate_city_csv('chicago.csv', 5000, stations=50, seed=2)
+
+    assert bikeshare.refresh_city('chicago') == 5000
+    assert bikeshare.get_stats('chicago', 'all', 'all')['rows'] == 5000
+
+
+def test_append_keeps_one_station_dictionary(city_dir):
+    bikeshare.read_city('chicago')
+
+    # A station seen only as an End Station, and another seen only as a Start Station
+    appended = city_dir / 'appended.csv'
+    benchmark.generate_city_csv(str(appended), 3000, stations=50, seed=1)
+    new_rows = pd.read_csv(appended)
+    new_rows['End Station'] = 'Zeta New End'
+    new_rows.loc[:99, 'Start Station'] = 'Alpha New Start'
+    new_rows.to_csv('chicago.csv', mode='a', header=False, index=False)
+
+    df = bikeshare.read_city('chicago')
+    stations = bikeshare.station_dictionary('chicago')
+    assert list(df['Start Station'].cat.categories) == stations
+    assert list(df['End Station'].cat.categories) == stations
+    expected = pd.read_csv('chicago.csv')
+    for column in ['Start Station', 'End Station']:
+        assert df[column].astype(object).tolist() == expected[column].tolist()
+
+
+def write_split_station_store():
+    """Writes a column store whose station columns have different categories.
+
+    The busiest End Station, 'Zeta New End', never appears as a Start Station.
+
+    Returns:
+        df - the frame that was stored
+    """
+    rows = pd.read_csv('chicago.csv')
+    rows.loc[:4999, 'End Station'] = 'Zeta New End'
+    rows.to_csv('chicago.csv', index=False)
+    df = bikeshare.parse_city_csv('chicago')
+    for column in ['Start Station', 'End Station']:
+        df[column] = df[column].astype(object).astype('category')
+    bikeshare.write_city_cache('chicago', {'signature': bikeshare.source_signature('chicago.csv'),
+                                           'mark': bikeshare.file_mark('chicago.csv'), 'df': df})
+    return df
+
+
+def test_approx_counts_end_only_stations(city_dir):
+    exact = bikeshare.compute_stats(write_split_station_store(), 'chicago')
+    approx = bikeshare.approx_stats('chicago', 'all', 'all')
+
+    assert approx['popular_end_station'] == exact['popular_end_station'] == 'Zeta New End'
+    assert approx['popular_trip'][:2] == exact['popular_trip'][:2]
+    # Count-Min estimates may only ever be too high
+    assert exact['popular_trip'][2] <= approx['popular_trip'][2] <= (
+        exact['popular_trip'][2] + approx['error_bounds']['route_count'])
+
+
+def test_od_counts_end_only_stations(city_dir):
+    df = write_split_station_store()
+    routes = df.groupby(['Start Station', 'End Station'], observed=True).size().sort_values(ascending=False)
+
+    od = bikeshare.build_od('chicago')
+    assert bikeshare.od_top_routes(od, 'all', 'all', 1)[0] == (routes.index[0], int(routes.iloc[0]))
+    assert int(bikeshare.od_entries(od, 'all', 'all')[2].sum()) == len(df)
+
+
+@pytest.mark.parametrize('city', ['chicago', 'washington'])
+def test_stream_with_no_matching_rows(city_dir, monkeypatch, city):
+    monkeypatch.setitem(bikeshare.CITY_DATA, city, city + '.csv')
+    benchmark.generate_city_csv(city + '.csv', 5000, stations=50, seed=3, user_details=city != 'washington')
+    rows = pd.read_csv(city + '.csv')
+    rows[rows['Start Time'].str.slice(5, 7) == '03'].to_csv(city + '.csv', index=False)
+
+    df = pd.read_csv(city + '.csv')
+    bikeshare.add_time_columns(df)
+    expected = bikeshare.stats_record(city, 'june', 'all', bikeshare.compute_stats(filter_frame(df, 'june', 'all'),
+                                                                                   city))
+    streamed = bikeshare.stats_record(city, 'june', 'all', bikeshare.stream_stats(city, 'june', 'all'))
+    assert json.dumps(streamed, sort_keys=True) == json.dumps(expected, sort_keys=True)
+    assert streamed['rows'] == 0
+
+
+def test_cold_filtered_load_scans_only_matching_rows(city_dir, monkeypatch):
+    expected = bikeshare.parse_city_csv('chicago')
+    expected = filter_frame(expected, 'march', 'friday')
+
+    # Nothing is cached, so the query must not parse the whole city in the foreground
+    monkeypatch.setattr(bikeshare, 'prefetch_city', lambda city, speculative=False: None)
+    monkeypatch.setattr(bikeshare, 'parse_city_csv', None)
+    df = bikeshare.load_data('chicago', 'march', 'friday')
+
+    assert df.index.equals(expected.index)
+    assert list(df.columns) == list(expected.columns)
+    for column in expected.columns:
+        assert df[column].astype(object).equals(expected[column].astype(object))
+
+
+def pandas_time_columns(values):
+    """Returns the Start Time, month, weekday and hour columns as plain pandas computes them."""
+    start_time = pd.to_datetime(pd.Series(values))
+    return (start_time, start_time.dt.month.fillna(-1).tolist(), start_time.dt.weekday.fillna(-1).tolist(),
+            start_time.dt.hour.fillna(-1).tolist())
+
+
+def check_time_columns(values):
+    """Checks add_time_columns on a Start Time column against pandas_time_columns."""
+    start_time, month, weekday, hour = pandas_time_columns(values)
+    df = bikeshare.add_time_columns(pd.DataFrame({'Start Time': values}))
+    # pandas may pick a coarser resolution than nanoseconds, so only the values are compared
+    pd.testing.assert_series_equal(df['Start Time'], start_time, check_dtype=False, check_names=False)
+    assert df['month'].tolist() == month
+    assert df['day_of_week'].cat.codes.tolist() == weekday
+    assert df['hour'].tolist() == hour
+
+
+def test_parse_timestamps_matches_pandas():
+    # Includes a leap day, the last second of a year and days either side of the epoch
+    values = ['2016-02-29 23:59:59', '2017-12-31 23:59:59', '2018-01-01 00:00:00', '1969-12-31 12:30:00',
+              '1970-01-01 00:00:00', '2017-06-30 07:08:09', '2000-02-29 00:00:01']
+    start_time, month, weekday, hour = pandas_time_columns(values)
+    parsed = bikeshare.parse_timestamps(values)
+
+    assert parsed is not None
+    assert (parsed[0] == start_time.to_numpy().astype('datetime64[ns]')).all()
+    assert parsed[1].tolist() == month
+    assert parsed[2].tolist() == weekday
+    assert parsed[3].tolist() == hour
+    check_time_columns(values)
+
+
+@pytest.mark.parametrize('values', [['2017-03-05 10:00:00', '2017-1-1 09:05:03'],
+                                    ['2017-03-05 10:00:00', float('nan')],
+                                    ['2017-01-01 00:00:00.500', '2017-03-05 10:00:00.250']])
+def test_parse_timestamps_falls_back_to_pandas(values):
+    assert bikeshare.parse_timestamps(values) is None
+    check_time_columns(values)
+
+
+@pytest.mark.parametrize('value', ['2017-02-30 10:00:00', '2017-02-29 10:00:00', '2017-04-31 10:00:00',
+                                   '2017-01-01 00:00:00.500'])
+def test_parse_timestamps_rejects_what_pandas_rejects(value):
+    values = ['2017-03-05 10:00:00', value]
+    assert bikeshare.parse_timestamps(values) is None
+    with pytest.raises(ValueError):
+        pd.to_datetime(pd.Series(values))
+    with pytest.raises(ValueError):
+        bikeshare.add_time_columns(pd.DataFrame({'Start Time': values}))
+
+
+def test_missing_start_times_count_only_without_filters(city_dir):
+    rows = pd.read_csv('chicago.csv')
+    rows.loc[::100, 'Start Time'] = None
+    rows.to_csv('chicago.csv', index=False)
+    df = bikeshare.read_city('chicago')
+    bikeshare.build_cube('chicago')
+    od = bikeshare.build_od('chicago')
+
+    for month, day in QUERIES:
+        expected = bikeshare.stats_record('chicago', month, day,
+                                          bikeshare.compute_stats(filter_frame(df, month, day), 'chicago'))
+        cubed = bikeshare.stats_record('chicago', month, day, bikeshare.get_stats('chicago', month, day))
+        assert json.dumps(cubed, sort_keys=True) == json.dumps(expected, sort_keys=True)
+        assert int(bikeshare.od_entries(od, month, day)[2].sum()) == expected['rows']
+    assert bikeshare.approx_stats('chicago', 'all', 'all')['rows'] == len(df)
+
+
+@pytest.fixture
+def service(city_dir):
+    """Runs serve on a free localhost port in a background thread and yields its base URL."""
+    started, state = threading.Event(), {}
+
+    async def run():
+        state['loop'], state['task'] = asyncio.get_running_loop(), asyncio.current_task()
+        try:
+            await bikeshare.serve('127.0.0.1', 0, workers=2,
+                                  ready=lambda address: (state.update(address=address), started.set()))
+        finally:
+            started.set()
+
+    def run_thread():
+        try:
+            asyncio.run(run())
+        except asyncio.CancelledError:
+            pass
+
+    thread = threading.Thread(target=run_thread, daemon=True)
+    thread.start()
+    assert started.wait(60) and 'address' in state
+    yield 'http://%s:%d' % state['address']
+    state['loop'].call_soon_threadsafe(state['task'].cancel)
+    thread.join(10)
+    assert not thread.is_alive()
+
+
+def test_serve_answers_stats_on_localhost(service):
+    with urllib.request.urlopen(service + '/stats?city=chicago&month=march&day=all', timeout=30) as response:
+        assert response.status == 200
+        served = json.load(response)
+    expected = bikeshare.stats_record('chicago', 'march', 'all', bikeshare.compute_stats(
+        bikeshare.load_data('chicago', 'march', 'all'), 'chicago'))
+    assert served == json.loads(json.dumps(expected))
+
+    with pytest.raises(urllib.error.HTTPError) as error:
+        urllib.request.urlopen(service + '/stats?city=boston&month=march&day=all', timeout=30)
+    assert error.value.code == 400
+    assert 'city must be one of' in json.load(error.value)['error']